@@ -0,0 +1,84 @@
+# Микробенчмарк разбора callback_data: старая цепочка if + пересборка клавиатур
+# против таблицы из menus.py. Сетевые вызовы не участвуют, меряется только CPU на одно нажатие.
+#   python bench/bench_dispatch.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot
+from menus import CATEGORIES, CATEGORY_BY_CALLBACK, UNKNOWN_CATEGORY_REPLY, CATEGORY_PREFIX
+
+ROUNDS = 20000
+SAMPLE = ["back_to_main", "product_selection", "help", "contacts", "news_feed", "news_page_2"] + [
+    CATEGORY_PREFIX + key for key, _, _ in CATEGORIES
+]
+
+
+# Как было до реестра меню: клавиатуры и category_map собираются заново на каждое нажатие
+def legacy_main_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("1. 🛍️ Выбор товара", callback_data="product_selection")],
+        [InlineKeyboardButton("2. ❓ Помощь", callback_data="help")],
+        [InlineKeyboardButton("3. 📞 Контакты", callback_data="contacts")],
+        [InlineKeyboardButton("4. 📢 Новости/Отгрузки", callback_data="news_feed")]
+    ])
+
+def legacy_categories_keyboard():
+    categories = [(title, key) for key, title, _ in CATEGORIES]
+    buttons = []
+    for i in range(0, len(categories), 2):
+        row = []
+        if i < len(categories):
+            row.append(InlineKeyboardButton(categories[i][0], callback_data=f"category_{categories[i][1]}"))
+        if i + 1 < len(categories):
+            row.append(InlineKeyboardButton(categories[i+1][0], callback_data=f"category_{categories[i+1][1]}"))
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(buttons)
+
+def legacy_cancel_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+
+def legacy_dispatch(data):
+    if data == "cancel":
+        return legacy_main_keyboard()
+    if data == "back_to_main":
+        return legacy_main_keyboard()
+    if data == "product_selection":
+        return legacy_categories_keyboard()
+    if data == "help":
+        return legacy_cancel_keyboard()
+    if data == "contacts":
+        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
+    if data == "news_feed":
+        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
+    if data.startswith("news_page_"):
+        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
+    if data.startswith("category_"):
+        category_map = {key: title for key, title, _ in CATEGORIES}
+        category = category_map.get(data.replace("category_", ""), "📦 Неизвестная категория")
+        return category, legacy_cancel_keyboard()
+
+def registry_dispatch(data):
+    handler = bot.find_button_handler(data)
+    if handler is bot.button_category:
+        return CATEGORY_BY_CALLBACK.get(data, UNKNOWN_CATEGORY_REPLY)
+    return handler
+
+def run(name, dispatch):
+    def tap_all():
+        for data in SAMPLE:
+            dispatch(data)
+    best = min(timeit.repeat(tap_all, number=ROUNDS // len(SAMPLE), repeat=5))
+    per_tap = best / (ROUNDS // len(SAMPLE) * len(SAMPLE)) * 1e6
+    print(f"{name:10} {per_tap:8.2f} мкс на нажатие")
+    return per_tap
+
+if __name__ == '__main__':
+    before = run("if-chain", legacy_dispatch)
+    after = run("registry", registry_dispatch)
+    print(f"ускорение: x{before / after:.1f}")
@@ -0,0 +1,162 @@
+# Фейковый Bot API для нагрузочных тестов: работает в том же процессе и event loop, что и бот,
+# записывает все вызовы, может добавлять задержку и отвечать 429 (RetryAfter) на отправку в группы.
+# Бот подключается к нему через BOT_API_URL=http://127.0.0.1:<port>/bot
+# getUpdates отдаёт апдейты, добавленные через push_update, и как Telegram забывает их,
+# только когда следующий getUpdates придёт с offset больше их update_id.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web import WebServer
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Методы, которые вызывает бот. Неизвестный метод получит 404 - так видно, что пора дописать
+API_METHODS = (
+    "getMe", "deleteWebhook", "setWebhook", "getUpdates",
+    "sendMessage", "editMessageText", "answerCallbackQuery", "deleteMessage",
+    "sendPhoto", "sendDocument", "sendMediaGroup", "copyMessage",
+)
+
+
+class FakeBotApi:
+    def __init__(self, token, port=0, latency=0.0, jitter=0.0, retry_after_rate=0.0, retry_after=1, seed=0):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.server = WebServer(port, host="127.0.0.1")
+        self.calls = []          # (время, метод, параметры)
+        self.retry_afters = 0
+        self._message_id = 1000
+        self._waiters = []       # (chat_id, методы, accept, future)
+        self.updates = []        # неподтверждённые апдейты для getUpdates
+        self._new_updates = asyncio.Event()
+        for method in API_METHODS:
+            self.server.route("POST", f"/bot{token}/{method}", self._make_handler(method))
+
+    @property
+    def port(self):
+        return self.server.server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        # Отпускаем висящие long polling запросы, иначе они отменятся вместе с сервером
+        self._new_updates.set()
+        await self.server.stop()
+
+    def count(self, exclude=("getMe", "deleteWebhook", "setWebhook", "getUpdates")):
+        by_method = {}
+        for _, method, _ in self.calls:
+            if method not in exclude:
+                by_method[method] = by_method.get(method, 0) + 1
+        return by_method
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self._new_updates.set()
+
+    async def _get_updates(self, params):
+        offset = params.get("offset") or 0
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and params.get("timeout"):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(params["timeout"], 1))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:params.get("limit") or 100]
+
+    def wait_for(self, chat_id, methods, accept=None):
+        # Future, которая завершится на следующем вызове одного из methods для chat_id;
+        # accept(params) может отсеять посторонние вызовы (например, рассылку новостей)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((chat_id, methods, accept, future))
+        return future
+
+    def _notify(self, method, params):
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        for waiter in self._waiters:
+            waiter_chat, methods, accept, future = waiter
+            if waiter_chat == chat_id and method in methods and not future.done() and (accept is None or accept(params)):
+                future.set_result(time.perf_counter())
+                self._waiters.remove(waiter)
+                return
+
+    def _message(self, params, **extra):
+        self._message_id += 1
+        chat_id = params.get("chat_id", 0)
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": BOT_USER,
+        }
+        message.update(extra)
+        return message
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {**BOT_USER, "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self._message(params, photo=[{"file_id": params.get("photo"), "file_unique_id": "u", "width": 1, "height": 1}])
+        if method == "sendDocument":
+            return self._message(params, document={"file_id": params.get("document"), "file_unique_id": "u"})
+        if method == "sendMediaGroup":
+            return [
+                self._message(params, photo=[{"file_id": item.get("media"), "file_unique_id": "u", "width": 1, "height": 1}])
+                for item in params.get("media", [])
+            ]
+        if method == "copyMessage":
+            self._message_id += 1
+            return {"message_id": self._message_id}
+        return True
+
+    def _make_handler(self, method):
+        async def handler(headers, body):
+            params = {}
+            for key, value in parse_qsl(body.decode("utf-8")):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            self.calls.append((time.perf_counter(), method, params))
+            # 429 отдаём только на отправку в группы: её бот повторяет через outbox,
+            # а ответы покупателю из обработчиков не повторяются
+            chat_id = params.get("chat_id")
+            if isinstance(chat_id, int) and chat_id < 0 and self.random.random() < self.retry_after_rate:
+                self.retry_afters += 1
+                return 429, "application/json", json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                })
+            if method == "getUpdates":
+                result = await self._get_updates(params)
+            else:
+                result = self._result(method, params)
+            self._notify(method, params)
+            return 200, "application/json", json.dumps({"ok": True, "result": result})
+        return handler
@@ -0,0 +1,236 @@
+# Нагрузочный тест бота без сети: фейковый Bot API (bench/fake_bot_api.py) + синтетические апдейты.
+# N покупателей параллельно проходят /start -> product_selection -> category_* -> сообщение с запросом,
+# админы добавляют новости через /add_news. Каждый шаг ждёт ответа бота, как живой пользователь.
+#   python bench/loadtest.py --customers 200 --admins 2 --latency 0.02 --retry-after-rate 0.02
+# Нагрузка определяется --seed, результаты пишутся в консоль.
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotApi
+
+TOKEN = "123456:BENCH"
+GROUP_ID = -100500
+STEP_TIMEOUT = 30
+# Новости от /add_news рассылаются подписчикам, то есть и покупателям из теста.
+# Рассылка не ответ на шаг покупателя, поэтому ожидание шага её пропускает
+BROADCAST_MARK = "Отписаться от новостей"
+
+
+def is_reply(params):
+    return BROADCAST_MARK not in str(params.get("text") or params.get("caption") or "")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class UpdateFactory:
+    def __init__(self, bot, Update):
+        self.bot = bot
+        self.Update = Update
+        self.update_id = 0
+        self.message_id = 0
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _next(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def message(self, uid, text=None, photo=None, caption=None):
+        update_id, message_id = self._next()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo is not None:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 800, "height": 600}]
+            if caption:
+                message["caption"] = caption
+        return self.Update.de_json({"update_id": update_id, "message": message}, self.bot)
+
+    def callback(self, uid, data):
+        update_id, message_id = self._next()
+        return self.Update.de_json({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                    "text": "menu",
+                },
+            },
+        }, self.bot)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.latencies = {}   # шаг -> список задержек ответа, с
+        self.completed = 0
+        self.failed = 0
+        self.updates = 0
+
+    async def step(self, name, uid, update, methods):
+        # Отправляем апдейт и ждём ответного вызова Bot API в чат пользователя
+        waiter = self.api.wait_for(uid, methods, accept=is_reply)
+        started = time.perf_counter()
+        self.updates += 1
+        await self.application.update_queue.put(update)
+        try:
+            finished = await asyncio.wait_for(waiter, STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.failed += 1
+            return False
+        self.latencies.setdefault(name, []).append(finished - started)
+        return True
+
+    async def customer(self, uid, plan):
+        category, with_photo, think = plan
+        await asyncio.sleep(think)
+        f = self.factory
+        if not await self.step("start", uid, f.message(uid, "/start"), ("sendMessage",)):
+            return
+        if not await self.step("product_selection", uid, f.callback(uid, "product_selection"), ("editMessageText",)):
+            return
+        if not await self.step("category", uid, f.callback(uid, f"category_{category}"), ("editMessageText",)):
+            return
+        text = f"VIN WDB{uid:09d} нужна фара"
+        if with_photo:
+            update = f.message(uid, photo=f"photo{uid}", caption=text)
+        else:
+            update = f.message(uid, text)
+        if await self.step("request", uid, update, ("sendMessage",)):
+            self.completed += 1
+
+    async def admin(self, uid, index):
+        f = self.factory
+        if not await self.step("add_news", uid, f.message(uid, "/add_news"), ("sendMessage",)):
+            return
+        if not await self.step("news_text", uid, f.message(uid, f"Отгрузка #{index}"), ("sendMessage",)):
+            return
+        await self.step("news_skip", uid, f.message(uid, "/skip"), ("sendMessage",))
+
+    async def run(self):
+        args = self.args
+        tmp = tempfile.mkdtemp(prefix="bot-bench-")
+        self.api = FakeBotApi(TOKEN, latency=args.latency, jitter=args.jitter,
+                              retry_after_rate=args.retry_after_rate, seed=args.seed)
+        await self.api.start()
+
+        os.environ.update({
+            "TOKEN": TOKEN,
+            "TELEGRAM_GROUP_ID": str(GROUP_ID),
+            "BOT_API_URL": self.api.base_url,
+            "DB_PATH": os.path.join(tmp, "bot.db"),
+            "NEWS_PATH": os.path.join(tmp, "news.json"),
+            "PORT": "0",
+            "MAX_CONCURRENT_UPDATES": str(args.concurrency),
+            "ADMIN_IDS": ",".join(str(1_000 + i) for i in range(args.admins)),
+            "LOG_LEVEL": "WARNING",
+        })
+        import bot
+        from telegram import Update
+        from menus import CATEGORIES
+        # Лимиты Telegram фейковому серверу не нужны, иначе тест упрётся в 20 сообщений в минуту в группу
+        bot.outbox.global_bucket.rate = bot.outbox.global_bucket.capacity = 1e6
+        bot.outbox.group_rate = bot.outbox.group_burst = 1e6
+        bot.outbox.backoff = 0.05
+
+        self.application = bot.build_application()
+        self.factory = UpdateFactory(self.application.bot, Update)
+        await self.application.initialize()
+        await bot.on_startup(self.application)
+        await self.application.start()
+
+        categories = [key for key, _, _ in CATEGORIES]
+        plans = [
+            (self.random.choice(categories), self.random.random() < args.photo_rate, self.random.uniform(0, args.ramp))
+            for _ in range(args.customers)
+        ]
+        started = time.perf_counter()
+        await asyncio.gather(
+            *[self.customer(10_000 + i, plan) for i, plan in enumerate(plans)],
+            *[self.admin(1_000 + i, i) for i in range(args.admins)],
+        )
+        handled = time.perf_counter() - started
+        # Дожидаемся, пока очередь исходящих доставит все запросы в группу
+        await bot.outbox.queue.join()
+        delivered = time.perf_counter() - started
+
+        await self.application.stop()
+        await bot.on_shutdown(self.application)
+        await self.application.shutdown()
+        await self.api.stop()
+        self.report(handled, delivered)
+
+    def report(self, handled, delivered):
+        args = self.args
+        calls = self.api.count()
+        total_calls = sum(calls.values())
+        group_calls = sum(
+            1 for _, method, params in self.api.calls
+            if isinstance(params.get("chat_id"), int) and params["chat_id"] < 0
+        )
+        print(f"покупателей: {args.customers}, админов: {args.admins}, seed: {args.seed}, "
+              f"задержка API: {args.latency * 1000:.0f} мс, параллельность: {args.concurrency}")
+        print(f"апдейтов: {self.updates}, завершено запросов: {self.completed}, шагов без ответа: {self.failed}")
+        print(f"время: обработка {handled:.2f} с, доставка в группу {delivered:.2f} с")
+        print(f"пропускная способность: {self.completed / handled:.1f} запросов/с, {self.updates / handled:.1f} апдейтов/с")
+        print("задержка ответа по шагам, мс:")
+        for name, values in self.latencies.items():
+            print(f"  {name:18} p50 {percentile(values, 50) * 1000:7.1f}   p99 {percentile(values, 99) * 1000:7.1f}   n={len(values)}")
+        broadcasts = sum(1 for _, _, params in self.api.calls if not is_reply(params))
+        print(f"вызовов Bot API: {total_calls} (429 отдано: {self.api.retry_afters}, рассылка новостей: {broadcasts})")
+        for method, count in sorted(calls.items()):
+            print(f"  {method:20} {count}")
+        if self.completed:
+            print(f"вызовов API на запрос: всего {total_calls / self.completed:.2f}, в группу {group_calls / self.completed:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for bot.py")
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.02, help="Bot API latency, s")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, s")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of group sends answered with 429")
+    parser.add_argument("--photo-rate", type=float, default=0.3, help="share of requests with a photo")
+    parser.add_argument("--ramp", type=float, default=1.0, help="customers start within this many seconds")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# Проверка перезапуска без потерь: фейковый Bot API копит апдейты, бот (python main.py) запускается
+# отдельным процессом, посреди разбора очереди получает SIGTERM (или SIGKILL с --kill) и запускается снова.
+# Каждый покупатель проходит весь сценарий запроса: /start -> product_selection -> category_* -> текст
+# запроса, и бот отвечает приветствием, двумя правками меню и подтверждением "Ваш запрос ... отправлен",
+# а запрос уходит в группу через очередь отправки (Outbox). Остановка приходится на момент, когда
+# часть покупателей уже получила подтверждение, а их запросы ещё ждут отправки в группу.
+# Пока бот остановлен, приходят ещё --while-down покупателей. Печатается и время холодного старта.
+# Запрос в группе и подтверждение должны быть у каждого покупателя ровно по одному. После SIGKILL
+# допустимы единичные повторы: вызов Bot API, ответ на который процесс не успел записать (подтверждение
+# до отметки confirmed, отправка в группу до записи прогресса задания), и ответы на апдейты, обработанные
+# за последние flush_interval журнала (см. UpdateInbox), - они ещё не отмечены и прогоняются снова.
+# Потерь не должно быть ни в одном режиме.
+#   python bench/restart_check.py --customers 300 --latency 0.01 --kill
+import os
+import re
+import sys
+import time
+import json
+import socket
+import signal
+import asyncio
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotApi
+from menus import CATEGORIES
+
+TOKEN = "123456:BENCH"
+GROUP_ID = -100500
+CONFIRMATION = "✅ Ваш запрос"
+REQUEST_TEXT = "VIN WDB{uid:09d} нужна фара"
+REQUEST_UID = re.compile(r"VIN WDB(\d{9}) ")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_update(update_id, uid):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def callback_update(update_id, uid, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}"},
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def text_update(update_id, uid, text):
+    update = start_update(update_id, uid)
+    message = update["message"]
+    message["text"] = text
+    del message["entities"]
+    return update
+
+
+def customer_updates(uids, first_update_id):
+    # Апдейты идут вперемешку между покупателями, но по порядку у каждого
+    update_id = first_update_id
+    steps = []
+    for step in range(4):
+        for i, uid in enumerate(uids):
+            update_id += 1
+            if step == 0:
+                steps.append(start_update(update_id, uid))
+            elif step == 1:
+                steps.append(callback_update(update_id, uid, "product_selection"))
+            elif step == 2:
+                key = CATEGORIES[i % len(CATEGORIES)][0]
+                steps.append(callback_update(update_id, uid, f"category_{key}"))
+            else:
+                steps.append(text_update(update_id, uid, REQUEST_TEXT.format(uid=uid)))
+    return steps
+
+
+def group_requests(calls):
+    # Запросы, дошедшие до группы: покупатель -> сколько раз
+    counts = {}
+    for _, method, params in calls:
+        if params.get("chat_id") != GROUP_ID:
+            continue
+        match = REQUEST_UID.search(str(params.get("text") or params.get("caption") or ""))
+        if match:
+            uid = int(match.group(1))
+            counts[uid] = counts.get(uid, 0) + 1
+    return counts
+
+
+class RestartCheck:
+    def __init__(self, args):
+        self.args = args
+        self.update_id = 0
+        self.users = []
+        self.runs = []   # (порт открыт, с; строка о холодном старте)
+
+    def push(self, count):
+        uids = [10_000 + len(self.users) + i for i in range(count)]
+        self.users.extend(uids)
+        for update in customer_updates(uids, self.update_id):
+            self.api.push_update(update)
+        self.update_id += 4 * count
+
+    def replies(self):
+        # Ответы в чатах покупателей: chat_id -> {(метод, текст): сколько раз}
+        replies = {}
+        for _, method, params in self.api.calls:
+            chat_id = params.get("chat_id")
+            if method in ("sendMessage", "editMessageText") and isinstance(chat_id, int) and chat_id > 0:
+                key = (method, str(params.get("text", ""))[:40])
+                counts = replies.setdefault(chat_id, {})
+                counts[key] = counts.get(key, 0) + 1
+        return replies
+
+    def confirmations(self):
+        counts = {}
+        for chat_id, replies in self.replies().items():
+            for (method, text), count in replies.items():
+                if text.startswith(CONFIRMATION):
+                    counts[chat_id] = counts.get(chat_id, 0) + count
+        return counts
+
+    def group_messages(self):
+        return group_requests(self.api.calls)
+
+    async def wait_port(self, port, started):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                return time.perf_counter() - started
+            except OSError:
+                await asyncio.sleep(0.005)
+
+    async def run_bot(self, env, until):
+        # Запускает бота и останавливает его, когда until() вернёт True
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "main.py"), env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        cold_start = []
+
+        async def read_log():
+            async for line in process.stderr:
+                line = line.decode("utf-8", "replace").rstrip()
+                if any(marker in line for marker in ("Cold start", "Port opened", "Из журнала")):
+                    cold_start.append(json.loads(line)["msg"])
+                if self.args.verbose:
+                    print("   ", line)
+
+        reader = asyncio.create_task(read_log())
+        port_open = await self.wait_port(int(env["PORT"]), started)
+        deadline = time.perf_counter() + self.args.timeout
+        while not until() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        process.send_signal(signal.SIGKILL if self.args.kill and not self.runs else signal.SIGTERM)
+        await process.wait()
+        await reader
+        self.runs.append((port_open, cold_start))
+
+    async def run(self):
+        args = self.args
+        tmp = tempfile.mkdtemp(prefix="bot-restart-")
+        self.api = FakeBotApi(TOKEN, latency=args.latency)
+        await self.api.start()
+        env = dict(os.environ,
+                   TOKEN=TOKEN, TELEGRAM_GROUP_ID=str(GROUP_ID), BOT_API_URL=self.api.base_url,
+                   DB_PATH=os.path.join(tmp, "bot.db"), NEWS_PATH=os.path.join(tmp, "news.json"),
+                   PORT=str(free_port()), BOT_MODE="polling", LOG_FORMAT="json", GROUP_RATE=str(args.group_rate))
+
+        self.push(args.customers)
+        stop_at = int(args.customers * args.stop_at)
+        await self.run_bot(env, lambda: len(self.confirmations()) >= stop_at)
+        confirmed, delivered = len(self.confirmations()), len(self.group_messages())
+        self.push(args.while_down)
+        await self.run_bot(env, lambda: (
+            len(self.confirmations()) >= len(self.users) and len(self.group_messages()) >= len(self.users)
+        ))
+        await self.api.stop()
+
+        confirmations, group = self.confirmations(), self.group_messages()
+        replies = self.replies()
+        lost = [uid for uid in self.users if uid not in group]
+        unconfirmed = [uid for uid in self.users if uid not in confirmations]
+        duplicated = [uid for uid, count in group.items() if count > 1]
+        confirmed_twice = [uid for uid, count in confirmations.items() if count > 1]
+        repeated = [uid for uid in self.users if any(count > 1 for count in replies.get(uid, {}).values())]
+        print(f"покупателей: {len(self.users)} ({args.customers} до остановки, {args.while_down} пока бот стоял), "
+              f"остановка: {'SIGKILL' if args.kill else 'SIGTERM'}; в первом запуске подтверждено {confirmed}, "
+              f"в группе {delivered}")
+        for index, (port_open, lines) in enumerate(self.runs, 1):
+            print(f"запуск {index}: порт открыт через {port_open:.2f} с; " + "; ".join(lines))
+        print(f"запросов в группе: {sum(group.values())}; не дошло: {len(lost)}, дошло дважды: {len(duplicated)}")
+        print(f"подтверждений: {sum(confirmations.values())}; без подтверждения: {len(unconfirmed)}, "
+              f"подтверждено дважды: {len(confirmed_twice)}")
+        print(f"покупателей с повторным ответом: {len(repeated)}")
+        return not lost and not unconfirmed and (args.kill or not (duplicated or confirmed_twice or repeated))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restart check: no request is lost or sent twice")
+    parser.add_argument("--customers", type=int, default=300)
+    parser.add_argument("--while-down", type=int, default=50, help="customers arriving while the bot is stopped")
+    parser.add_argument("--stop-at", type=float, default=0.5,
+                        help="stop the first run after this share of customers got a confirmation")
+    parser.add_argument("--group-rate", type=int, default=1200, help="group messages per minute (GROUP_RATE)")
+    parser.add_argument("--latency", type=float, default=0.01, help="Bot API latency, s")
+    parser.add_argument("--kill", action="store_true", help="stop the first run with SIGKILL instead of SIGTERM")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(RestartCheck(args).run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
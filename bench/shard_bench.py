@@ -0,0 +1,135 @@
+# Масштабирование по процессам: один и тот же поток апдейтов обрабатывается ботом в одном процессе
+# и пулом из N воркеров (SHARD_WORKERS=N, см. shard.py), бот запускается через main.py как в проде.
+# Фейковый Bot API (bench/fake_bot_api.py) копит апдейты для getUpdates: каждый покупатель
+# проходит /start -> product_selection -> category_* -> запрос. Время считается до последнего
+# подтверждения "Ваш запрос ... отправлен". Задержка API по умолчанию нулевая, чтобы упираться в CPU.
+# Фейковый API работает в процессе бенчмарка и занимает одно ядро, поэтому ядер нужно больше N.
+# Затем бенчмарк ждёт, пока все запросы дойдут до группы: они уходят через очередь отправки
+# (Outbox) с общим лимитом Bot API ~25 в секунду, поэтому доставка заметно дольше обработки.
+# С --resize M пул из N > 1 воркеров посреди прогона меняет размер на M (POST /pool/<секрет>):
+# воркеры получают SIGTERM, и очередь в группу должна дойти от новых воркеров без потерь и повторов.
+#   python bench/shard_bench.py --customers 2000 --workers 1 2 4
+#   python bench/shard_bench.py --customers 500 --workers 2 --resize 3
+import os
+import sys
+import time
+import signal
+import asyncio
+import secrets
+import argparse
+import tempfile
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotApi
+from restart_check import free_port, customer_updates, group_requests
+
+TOKEN = "123456:BENCH"
+GROUP_ID = -100500
+CONFIRMATION = "✅ Ваш запрос"
+
+
+async def wait_port(port, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.02)
+    return False
+
+
+async def resize_pool(port, secret, size):
+    async with httpx.AsyncClient(timeout=120) as client:
+        response = await client.post(f"http://127.0.0.1:{port}/pool/{secret}", content=str(size))
+        response.raise_for_status()
+
+
+async def run_pool(args, workers):
+    tmp = tempfile.mkdtemp(prefix="bot-shard-")
+    api = FakeBotApi(TOKEN, latency=args.latency)
+    await api.start()
+    port = free_port()
+    secret = secrets.token_urlsafe(16)
+    env = dict(os.environ,
+               TOKEN=TOKEN, TELEGRAM_GROUP_ID=str(GROUP_ID), BOT_API_URL=api.base_url,
+               DB_PATH=os.path.join(tmp, "bot.db"), NEWS_PATH=os.path.join(tmp, "news.json"),
+               PORT=str(port), SHARD_BASE_PORT=str(port + 1), SHARD_WORKERS=str(workers), SHARD_SECRET=secret,
+               GROUP_RATE=str(args.group_rate), BOT_MODE="polling", LOG_LEVEL="WARNING")
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "main.py"), env=env)
+    ports = [port] if workers == 1 else [port + 1 + i for i in range(workers)]
+    for p in ports:
+        await wait_port(p)
+    await asyncio.sleep(args.warmup)
+
+    # Пул из одного процесса запускается без ingress, менять его размер нечем
+    resize = args.resize if args.resize and workers > 1 else None
+    resizing = None
+    updates = customer_updates([10_000 + i for i in range(args.customers)], 0)
+    started = time.perf_counter()
+    for update in updates:
+        api.push_update(update)
+    confirmed = 0
+    seen = 0
+    deadline = started + args.timeout
+    while confirmed < args.customers and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+        calls = api.calls
+        for _, method, params in calls[seen:]:
+            if method == "sendMessage" and str(params.get("text", "")).startswith(CONFIRMATION):
+                confirmed += 1
+        seen = len(calls)
+        if resize and resizing is None and confirmed >= args.customers // 2:
+            resizing = asyncio.create_task(resize_pool(port, secret, resize))
+    elapsed = time.perf_counter() - started
+
+    # Подтверждение покупателю уходит раньше, чем запрос в группу: дожидаемся очереди отправки
+    group = group_requests(api.calls)
+    while len(group) < args.customers and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+        group = group_requests(api.calls)
+    delivered = time.perf_counter() - started
+    if resizing is not None:
+        await resizing
+
+    process.send_signal(signal.SIGTERM)
+    await process.wait()
+    await api.stop()
+    duplicated = sum(1 for count in group.values() if count > 1)
+    return confirmed, len(updates), elapsed, len(group), duplicated, delivered, resize
+
+
+async def main_async(args):
+    print(f"ядер: {os.cpu_count()}, покупателей: {args.customers}, задержка API: {args.latency * 1000:.0f} мс")
+    base = None
+    for workers in args.workers:
+        confirmed, updates, elapsed, group, duplicated, delivered, resize = await run_pool(args, workers)
+        rate = updates / elapsed
+        base = base or rate
+        pool = f"{workers:2} -> {resize}" if resize else f"{workers:2}"
+        print(f"воркеров: {pool}  запросов: {confirmed}/{args.customers}  время: {elapsed:6.2f} с  "
+              f"{rate:7.1f} апдейтов/с  x{rate / base:.2f}  "
+              f"в группе: {group}/{args.customers} (дважды: {duplicated}) за {delivered:6.2f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the bot with 1..N worker processes")
+    # Не больше 1000 на воркер: столько запросов вмещает очередь отправки в группу (Outbox.maxsize)
+    parser.add_argument("--customers", type=int, default=800)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API latency, s")
+    parser.add_argument("--warmup", type=float, default=1.0, help="pause after start before sending updates, s")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--resize", type=int, help="resize the pool to this many workers halfway through the run")
+    parser.add_argument("--group-rate", type=int, default=60000, help="group messages per minute (GROUP_RATE)")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
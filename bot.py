@@ -2,10 +2,11 @@ import os
 import logging
 import time
 import json
-import threading
-import http.server
-import socketserver
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import asyncio
+import signal
+import secrets
+import hashlib
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -15,105 +16,111 @@ from telegram.ext import (
     MessageHandler,
     filters
 )
-from telegram.error import TelegramError
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+from news_store import NewsStore
+from menus import (
+    MAIN_KEYBOARD,
+    CATEGORIES_KEYBOARD,
+    CANCEL_KEYBOARD,
+    BACK_KEYBOARD,
+    BACK_BUTTON,
+    CONTACTS_TEXT,
+    CATEGORY_PREFIX,
+    CATEGORY_BY_CALLBACK,
+    UNKNOWN_CATEGORY_REPLY,
 )
+from outbox import Outbox
+from ledger import RequestLedger
+from persistence import SqlitePersistence
+from broadcast import Broadcaster
+from inbox import UpdateInbox
+from dedup import DedupCache
+from web import WebServer
+from scheduler import PerUserUpdateProcessor
+from metrics import metrics, InstrumentedRequest
+from logs import setup_logging
+from shard import SHARD_INDEX, SHARD_COUNT, SHARD_PATH, owns, owns_chat
+
+# Настройка логирования: JSON через очередь в отдельный поток, см. logs.py
+log_handler = setup_logging()
 logger = logging.getLogger(__name__)
 
-# Простой HTTP server для Render
-class HealthHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Bot is alive!')
-        else:
-            self.send_response(404)
-            self.end_headers()
-
-def run_health_server():
-    port = int(os.environ.get("PORT", 5000))
-    with socketserver.TCPServer(("", port), HealthHandler) as httpd:
-        logger.info(f"Health server running on port {port}")
-        httpd.serve_forever()
-
 # Конфигурация
 TOKEN = os.getenv('TOKEN', '8091371448:AAERHwxB8CseSenyfCoHPuk-Y2BmNSo5kmU')
 GROUP_ID = int(os.getenv('TELEGRAM_GROUP_ID', '-1002789329715'))
+# Кто может добавлять новости (/add_news) и тем самым делать рассылку всем подписчикам:
+# user id через запятую. Пусто - никто
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if user_id}
+PORT = int(os.environ.get("PORT", 5000))
+# Адрес Bot API; меняется для локального Bot API сервера или фейкового сервера из bench/
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')
+# BOT_MODE=webhook - апдейты приходят POST-запросами на WEBHOOK_URL, иначе long polling.
+# BOT_MODE=worker - процесс из пула (shard.py), апдейты пересылает входной процесс на SHARD_PATH
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
+# Сколько апдейтов разных пользователей обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 16))
+# Сколько принятых апдейтов может ждать обработки, дальше приём новых приостанавливается
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', 1000))
+# Окна отсечения повторов, с: повторное нажатие той же кнопки и повторная отправка того же запроса
+CALLBACK_DEDUP_WINDOW = float(os.getenv('CALLBACK_DEDUP_WINDOW', 1.5))
+REQUEST_DEDUP_WINDOW = float(os.getenv('REQUEST_DEDUP_WINDOW', 600))
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 10000))
+
+# Журнал запросов покупателей
+DB_PATH = os.getenv('DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.db'))
+ledger = RequestLedger(DB_PATH)
+
+# Очередь исходящих сообщений в группу поставщиков, задания хранятся в bot.db.
+# Лимиты Telegram общие на бота: в пуле воркеров лимит на группу у воркеров общий (в bot.db),
+# а общий лимит на отправку каждый получает своей долей
+# GROUP_RATE - лимит на сообщения в группу в минуту; больше 20 - только для фейкового Bot API из bench/
+GROUP_RATE = int(os.getenv('GROUP_RATE', 20))
+outbox = Outbox(
+    DB_PATH, global_rate=25 / SHARD_COUNT, group_rate=GROUP_RATE / 60, group_burst=GROUP_RATE,
+    owns=owns_chat if SHARD_COUNT > 1 else None, shared_limits=SHARD_COUNT > 1
+)
 
-# Состояния для ConversationHandler
-TEXT, PHOTO_OR_DOC = range(2)
+# Подписчики и рассылка новостей
+broadcaster = Broadcaster(DB_PATH, rate=20 / SHARD_COUNT)
 
-# Главное меню
-def get_main_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("1. 🛍️ Выбор товара", callback_data="product_selection")],
-        [InlineKeyboardButton("2. ❓ Помощь", callback_data="help")],
-        [InlineKeyboardButton("3. 📞 Контакты", callback_data="contacts")],
-        [InlineKeyboardButton("4. 📢 Новости/Отгрузки", callback_data="news_feed")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-# Меню выбора категорий товаров
-def get_categories_keyboard():
-    categories = [
-        ("🚗 Автомобильные товары", "auto"),
-        ("🏍️ Мотоциклы и питбайки", "moto"),
-        ("🧸 Игрушки", "toys"),
-        ("👜 Сумки", "bags"),
-        ("👕 Одежда", "clothes"),
-        ("⚽ Спортивный инвентарь", "sport"),
-        ("📱 Электроника", "electronics"),
-        ("🏠 Бытовая техника", "appliances"),
-        ("🏠 Домашний декор", "decor"),
-        ("💄 Красота и здоровье", "beauty"),
-        ("💍 Ювелирка и аксессуары", "jewelry"),
-        ("🛠️ Инструменты и оборудование", "tools"),
-        ("📊 Офисные товары", "office"),
-        ("🧒 Детские товары", "kids"),
-        ("⚙️ Станки и механизмы", "machinery"),
-        ("📦 Другие товары", "other_items")
-    ]
-    
-    # Создаем кнопки по 2 в ряд
-    buttons = []
-    for i in range(0, len(categories), 2):
-        row = []
-        if i < len(categories):
-            row.append(InlineKeyboardButton(categories[i][0], callback_data=f"category_{categories[i][1]}"))
-        if i + 1 < len(categories):
-            row.append(InlineKeyboardButton(categories[i+1][0], callback_data=f"category_{categories[i+1][1]}"))
-        buttons.append(row)
-    
-    # Добавляем кнопку "Назад" в главное меню
-    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
-    
-    return InlineKeyboardMarkup(buttons)
+# Журнал входящих апдейтов: перезапуск не теряет и не повторяет апдейты
+inbox = UpdateInbox(DB_PATH, owns=owns if SHARD_COUNT > 1 else None, max_pending=MAX_PENDING_UPDATES)
 
-def get_cancel_keyboard():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+# Недавние нажатия кнопок (ключ - пользователь и сообщение, значение - callback_data)
+# и отправленные запросы (ключ - пользователь и хэш запроса)
+recent_callbacks = DedupCache(CALLBACK_DEDUP_WINDOW, DEDUP_CACHE_SIZE)
+recent_requests = DedupCache(REQUEST_DEDUP_WINDOW, DEDUP_CACHE_SIZE)
 
-# Функции для работы с новостями
-def get_news_path():
-    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'news.json')
+# Состояния для ConversationHandler
+TEXT, PHOTO_OR_DOC = range(2)
 
-def load_news():
-    try:
-        news_path = get_news_path()
-        with open(news_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+# Хранилище новостей
+NEWS_PATH = os.getenv('NEWS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'news.json'))
+news_store = NewsStore(NEWS_PATH)
+NEWS_PAGE_SIZE = 5  # не больше 10 - лимит send_media_group
+NEWS_TEXT_LIMIT = 700
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+def get_news_keyboard(page, pages):
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"news_page_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("Старее ➡️", callback_data=f"news_page_{page + 1}"))
+    buttons = [nav] if nav else []
+    buttons.append([BACK_BUTTON])
+    return InlineKeyboardMarkup(buttons)
 
-def save_news(news):
-    news_path = get_news_path()
-    with open(news_path, 'w', encoding='utf-8') as f:
-        json.dump(news, f, ensure_ascii=False, indent=4)
+def format_news_item(item, limit):
+    text = item.get('text') or ''
+    if len(text) > limit:
+        text = text[:limit - 1] + '…'
+    date = time.strftime('%d.%m.%Y', time.localtime(item.get('timestamp') or 0))
+    return f"📅 {date}\n{text}"
 
 # Вспомогательные функции
 async def cancel_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -121,34 +128,105 @@ async def cancel_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         await update.callback_query.edit_message_text(
             "❌ Запрос отменён.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     else:
         await update.message.reply_text(
             "❌ Запрос отменён.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
 
-async def send_to_group(context: ContextTypes.DEFAULT_TYPE, message: str, photo=None, document=None, username=None, request_id=None, category=None):
-    logger.info(f"Sending to group {GROUP_ID}: {message}")
+# Вызовы Bot API для пересылки вложений. Альбом (больше одного вложения) уходит одним
+# send_media_group, подпись ставится на первый элемент. Фото и документы Telegram
+# в одном альбоме смешивать не даёт, поэтому они идут разными группами.
+def media_calls(chat_id, photos, documents, caption=None):
+    calls = []
+    for kind, file_ids in (("photo", photos), ("document", documents)):
+        for i in range(0, len(file_ids), MEDIA_GROUP_LIMIT):
+            chunk = file_ids[i:i + MEDIA_GROUP_LIMIT]
+            if len(chunk) == 1:
+                kwargs = {"chat_id": chat_id, kind: chunk[0]}
+                if caption:
+                    kwargs["caption"] = caption
+                calls.append((f"send_{kind}", kwargs))
+            else:
+                media_type = InputMediaPhoto if kind == "photo" else InputMediaDocument
+                media = [media_type(media=file_id, caption=caption if j == 0 else None) for j, file_id in enumerate(chunk)]
+                calls.append(("send_media_group", {"chat_id": chat_id, "media": media}))
+            caption = None
+    return calls
+
+# Запрос ставится в очередь исходящих сообщений и уходит в группу в фоне,
+# покупатель получает подтверждение, как только задание записано в bot.db (см. Outbox).
+# Заголовок запроса идёт подписью к вложению, так что запрос приходит в группу одним сообщением
+# и одним вызовом API. Одиночное вложение копируется из чата покупателя (copy_message, source -
+# (chat_id, message_id)). Отдельное текстовое сообщение уходит, только если заголовок длиннее лимита подписи.
+# Возвращает False, если задание от апдейта update_id уже стоит в очереди (апдейт прогоняется повторно).
+async def send_to_group(context: ContextTypes.DEFAULT_TYPE, message: str, photos=(), documents=(), username=None, request_id=None, category=None, priority=Outbox.PRIORITY_REQUEST, source=None, chat_id=None, update_id=None):
+    logger.info("Sending to group %s: %s", GROUP_ID, message)
+    full_message = f"Запрос #{request_id} из категории '{category}' от @{username if username else 'неизвестный'}:\n{message}"
+    media_count = len(photos) + len(documents)
+    if media_count and len(full_message) <= CAPTION_LIMIT:
+        if media_count == 1 and source:
+            # Пока запрос ждёт в очереди, покупатель может удалить сообщение - тогда
+            # copy_message получит BadRequest и вложение уйдёт по сохранённому file_id
+            calls = [("copy_message", {
+                "chat_id": GROUP_ID,
+                "from_chat_id": source[0],
+                "message_id": source[1],
+                "caption": full_message
+            }, media_calls(GROUP_ID, photos, documents, caption=full_message)[0])]
+        else:
+            calls = media_calls(GROUP_ID, photos, documents, caption=full_message)
+    else:
+        calls = [("send_message", {"chat_id": GROUP_ID, "text": full_message})]
+        calls += media_calls(GROUP_ID, photos, documents)
     try:
-        full_message = f"Запрос #{request_id} из категории '{category}' от @{username if username else 'неизвестный'}:\n{message}"
-        await context.bot.send_message(chat_id=GROUP_ID, text=full_message)
-        if photo:
-            await context.bot.send_photo(chat_id=GROUP_ID, photo=photo[-1].file_id)
-        if document:
-            await context.bot.send_document(chat_id=GROUP_ID, document=document.file_id)
-    except TelegramError as e:
-        logger.error(f"Ошибка Telegram: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Неизвестная ошибка отправки: {e}")
+        return await outbox.submit(priority, calls, update_id=update_id, request_id=request_id, chat_id=chat_id)
+    except asyncio.QueueFull:
+        logger.error("Очередь отправки переполнена (%s)", outbox.maxsize)
         raise
 
+# Страница ленты новостей: текст страницы правится в том же сообщении,
+# фото страницы уходят одним send_media_group. Не больше 2 запросов к API на нажатие.
+async def show_news_page(query, context, page):
+    total = news_store.count()
+    if not total:
+        await query.edit_message_text(
+            "📢 Пока новостей нет. Проверьте позже!",
+            reply_markup=BACK_KEYBOARD
+        )
+        return
+
+    pages = (total + NEWS_PAGE_SIZE - 1) // NEWS_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    items = news_store.page(page, NEWS_PAGE_SIZE)
+    text = f"📢 Последние новости и отгрузки (стр. {page + 1} из {pages}):\n\n"
+    text += "\n\n".join(format_news_item(item, NEWS_TEXT_LIMIT) for item in items)
+    await query.edit_message_text(text, reply_markup=get_news_keyboard(page, pages))
+
+    photos = [
+        InputMediaPhoto(media=item['photo'], caption=format_news_item(item, CAPTION_LIMIT - 20))
+        for item in items if item.get('photo')
+    ]
+    if len(photos) == 1:
+        await context.bot.send_photo(
+            chat_id=query.message.chat_id,
+            photo=photos[0].media,
+            caption=photos[0].caption
+        )
+    elif photos:
+        await context.bot.send_media_group(chat_id=query.message.chat_id, media=photos)
+
 # Обработчики
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    logger.info(f"Received /start from chat_id: {chat_id}")
+    logger.info("Received /start from chat_id: %s", chat_id)
+    if update.effective_chat.type == 'private':
+        try:
+            await broadcaster.subscribe(update.effective_user.id)
+        except Exception as e:
+            logger.error("Не удалось добавить подписчика %s: %s", chat_id, e)
     
     welcome_text = (
         "Добро пожаловать в 'Товары из Китая'! 🛒\n\n"
@@ -160,140 +238,98 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Выберите раздел в меню ниже:"
     )
     
-    await update.message.reply_text(welcome_text, reply_markup=get_main_keyboard())
+    await update.message.reply_text(welcome_text, reply_markup=MAIN_KEYBOARD)
 
-async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Обработчики кнопок. Каждый получает (update, context), как обычный обработчик PTB
+async def button_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await cancel_request(update, context)
+
+async def button_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    logger.info(f"Button pressed: {data}")
+    # Очищаем чат от предыдущих сообщений перед возвратом в главное меню
+    try:
+        # Пытаемся удалить сообщение с кнопками новостей
+        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+    except:
+        pass  # Если не получилось удалить - ничего страшного
+
+    # Отправляем чистое главное меню
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text="Главное меню:",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    if data == "cancel":
-        await cancel_request(update, context)
-        return
+async def button_product_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        "🏪 Выберите категорию товара:",
+        reply_markup=CATEGORIES_KEYBOARD
+    )
 
-    if data == "back_to_main":
-        # Очищаем чат от предыдущих сообщений перед возвратом в главное меню
-        try:
-            # Пытаемся удалить сообщение с кнопками новостей
-            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-        except:
-            pass  # Если не получилось удалить - ничего страшного
-        
-        # Отправляем чистое главное меню
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="Главное меню:",
-            reply_markup=get_main_keyboard()
-        )
-        return
+async def button_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        "❓ Опишите вашу проблему или предложение:",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    context.user_data['help_request'] = True
 
-    if data == "product_selection":
-        await query.edit_message_text(
-            "🏪 Выберите категорию товара:",
-            reply_markup=get_categories_keyboard()
-        )
-        return
+async def button_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(CONTACTS_TEXT, reply_markup=BACK_KEYBOARD)
 
-    if data == "help":
-        await query.edit_message_text(
-            "❓ Опишите вашу проблему или предложение:",
-            reply_markup=get_cancel_keyboard()
-        )
-        context.user_data['help_request'] = True
-        return
+async def button_news_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_news_page(update.callback_query, context, 0)
 
-    if data == "contacts":
-        contacts_text = (
-            "📞 Наши контакты:\n\n"
-            "🌐 Сайт: yuemo-logistics.ru\n"
-            "📱 WhatsApp: +86 153 2332 5277\n"
-            "✉️ Email: info@yuemo-logistics.ru\n\n"
-            "🕒 Время работы: 24/7"
-        )
-        await query.edit_message_text(
-            contacts_text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
-        )
-        return
+async def button_news_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await show_news_page(query, context, int(query.data.replace("news_page_", "")))
 
-    if data == "news_feed":
-        news = load_news()
-        if not news:
-            await query.edit_message_text(
-                "📢 Пока новостей нет. Проверьте позже!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
-            )
-        else:
-            # Сначала редактируем текущее сообщение
-            await query.edit_message_text(
-                "📢 Последние новости и отгрузки:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]])
-            )
-            
-            # Затем отправляем новости отдельными сообщениями
-            for item in news:
-                if item.get('text'):
-                    await context.bot.send_message(
-                        chat_id=query.message.chat_id,
-                        text=f"📅 {item['text']}"
-                    )
-                if item.get('photo'):
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=item['photo']
-                    )
-        return
+async def button_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    category, reply = CATEGORY_BY_CALLBACK.get(query.data, UNKNOWN_CATEGORY_REPLY)
+    context.user_data['category'] = category
+    await query.edit_message_text(reply, reply_markup=CANCEL_KEYBOARD)
+    context.user_data['free_request'] = True
+
+# Таблица разбора callback_data: точное совпадение - один поиск в словаре,
+# префиксы проверяются только если точного совпадения нет
+BUTTON_HANDLERS = {
+    "cancel": button_cancel,
+    "back_to_main": button_back_to_main,
+    "product_selection": button_product_selection,
+    "help": button_help,
+    "contacts": button_contacts,
+    "news_feed": button_news_feed,
+    **{data: button_category for data in CATEGORY_BY_CALLBACK},
+}
+BUTTON_PREFIX_HANDLERS = (
+    ("news_page_", button_news_page),
+    (CATEGORY_PREFIX, button_category),
+)
 
-    if data.startswith("category_"):
-        category_map = {
-            "auto": "🚗 Автомобильные товары",
-            "moto": "🏍️ Мотоциклы и питбайки",
-            "toys": "🧸 Игрушки",
-            "bags": "👜 Сумки",
-            "clothes": "👕 Одежда",
-            "sport": "⚽ Спортивный инвентарь",
-            "electronics": "📱 Электроника",
-            "appliances": "🏠 Бытовая техника",
-            "decor": "🏠 Домашний декор",
-            "beauty": "💄 Красота и здоровье",
-            "jewelry": "💍 Ювелирка и аксессуары",
-            "tools": "🛠️ Инструменты и оборудование",
-            "office": "📊 Офисные товары",
-            "kids": "🧒 Детские товары",
-            "machinery": "⚙️ Станки и механизмы",
-            "other_items": "📦 Другие товары"
-        }
-        
-        category_key = data.replace("category_", "")
-        category = category_map.get(category_key, "📦 Неизвестная категория")
-        context.user_data['category'] = category
-        
-        if category == "🚗 Автомобильные товары":
-            await query.edit_message_text(
-                f"Вы выбрали: {category}\n\n"
-                "🔍 Рекомендации для быстрого поиска:\n"
-                "• VIN номер\n"
-                "• Номер кузова\n" 
-                "• Марка и модель\n"
-                "• Год выпуска\n"
-                "• Код запчасти\n\n"
-                "📝 Опишите ваш запрос или приложите фото:",
-                reply_markup=get_cancel_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                f"Вы выбрали: {category}\n\n"
-                "🔍 Рекомендации для быстрого поиска:\n"
-                "• Код товара или артикул\n"
-                "• Фотографии товара\n"
-                "• Видео обзор\n"
-                "• Технические характеристики\n\n"
-                "📝 Опишите ваш запрос или приложите фото:",
-                reply_markup=get_cancel_keyboard()
-            )
-        context.user_data['free_request'] = True
+def find_button_handler(data):
+    handler = BUTTON_HANDLERS.get(data)
+    if handler is None:
+        for prefix, prefix_handler in BUTTON_PREFIX_HANDLERS:
+            if data.startswith(prefix):
+                return prefix_handler
+    return handler
+
+async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+    # Двойное нажатие: второй раз не пересылаем меню и ленту новостей.
+    # Для каждого сообщения помним только последнее нажатие, поэтому отсекается лишь повтор
+    # той же кнопки подряд, а "Помощь -> Отмена -> Помощь" или листание туда и обратно проходят
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    if recent_callbacks.repeated((update.effective_user.id, message_id), data):
+        logger.info("Duplicate button press ignored: %s", data)
         return
+    logger.info("Button pressed: %s", data)
+
+    handler = find_button_handler(data)
+    if handler is not None:
+        await handler(update, context)
 
 # Обработчик для добавления новостей
 async def start_add_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -317,17 +353,28 @@ async def get_news_photo_or_doc(update: Update, context: ContextTypes.DEFAULT_TY
         photo = update.message.photo[-1].file_id if update.message.photo else None
         document = update.message.document.file_id if update.message.document else None
 
-    news = load_news()
-    news.append({
+    # update_id - ключ новости и рассылки: повторно прогнанный апдейт их не дублирует
+    item = {
         "text": context.user_data['news_text'],
         "photo": photo,
         "document": document,
-        "timestamp": time.time()
-    })
-    save_news(news)
+        "timestamp": time.time(),
+        "update_id": update.update_id
+    }
+    # Диалог мог начаться до того, как пользователя убрали из ADMIN_IDS (состояние хранится в базе)
+    if update.effective_user.id not in ADMIN_IDS:
+        logger.warning("Новость от %s не добавлена: пользователя нет в ADMIN_IDS", update.effective_user.id)
+        context.user_data.clear()
+        return ConversationHandler.END
+    await news_store.add(item)
+    await broadcaster.broadcast(
+        news_id=f"update-{update.update_id}",
+        text=format_news_item(item, CAPTION_LIMIT - 60) + "\n\nОтписаться от новостей: /unsubscribe",
+        photo=photo
+    )
     await update.message.reply_text(
-        "✅ Новость добавлена в раздел Новости/Отгрузки.",
-        reply_markup=get_main_keyboard()
+        "✅ Новость добавлена в раздел Новости/Отгрузки и отправлена подписчикам.",
+        reply_markup=MAIN_KEYBOARD
     )
     context.user_data.clear()
     return ConversationHandler.END
@@ -335,18 +382,30 @@ async def get_news_photo_or_doc(update: Update, context: ContextTypes.DEFAULT_TY
 async def cancel_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "❌ Добавление новости отменено.",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
     context.user_data.clear()
     return ConversationHandler.END
 
+# Подписка на рассылку новостей
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await broadcaster.subscribe(update.effective_user.id, force=True)
+    await update.message.reply_text("🔔 Вы подписаны на новости и отгрузки.", reply_markup=MAIN_KEYBOARD)
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await broadcaster.unsubscribe(update.effective_user.id)
+    await update.message.reply_text(
+        "🔕 Вы отписались от новостей. Подписаться снова: /subscribe",
+        reply_markup=MAIN_KEYBOARD
+    )
+
 # Обработчик команды /cancel
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await cancel_request(update, context)
 
 # Настройка ConversationHandler для добавления новостей
 news_conv_handler = ConversationHandler(
-    entry_points=[CommandHandler("add_news", start_add_news)],
+    entry_points=[CommandHandler("add_news", start_add_news, filters=filters.User(ADMIN_IDS))],
     states={
         TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_news_text)],
         PHOTO_OR_DOC: [
@@ -355,80 +414,354 @@ news_conv_handler = ConversationHandler(
             CommandHandler("skip", get_news_photo_or_doc)
         ]
     },
-    fallbacks=[CommandHandler("cancel", cancel_news)]
+    fallbacks=[CommandHandler("cancel", cancel_news)],
+    name="news_conv",
+    persistent=True
 )
 
+# Отправка запроса покупателя или запроса помощи в группу и подтверждение покупателю
+def request_key(user_id, kind, category, text, photos, documents):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (kind, category, text or '', *photos, *documents):
+        digest.update(part.encode('utf-8') + b'\0')
+    return user_id, digest.digest()
+
+# update_id - апдейт, из которого создан запрос. Апдейт, повторно прогнанный после падения,
+# не создаёт второй запрос и не отвечает покупателю второй раз (см. Outbox.confirm),
+# а отмечается обработанным только после доставки запроса в группу (см. UpdateInbox.hold)
+async def submit_request(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id, username, kind, category, text, photos, documents, source=None, update_id=None):
+    # Тот же запрос от того же пользователя в пределах REQUEST_DEDUP_WINDOW повторно в группу не уходит
+    key = request_key(user_id, kind, category, text, photos, documents)
+    previous = recent_requests.get(key)
+    if previous is not None:
+        logger.info("Duplicate %s request from @%s ignored", kind, username)
+        number = f" #{previous}" if isinstance(previous, int) else ""
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"ℹ️ Этот запрос{number} уже отправлен, повторять его не нужно.", reply_markup=MAIN_KEYBOARD
+        )
+        return
+    recent_requests.put(key)
+    submitted = False
+    try:
+        if kind == 'help':
+            message = f"Запрос помощи от @{username}:\n{text}"
+            submitted = await send_to_group(context, message, photos, documents, username, priority=Outbox.PRIORITY_HELP, source=source, chat_id=chat_id, update_id=update_id)
+            reply = "✅ Ваш запрос помощи отправлен. Ожидайте ответа в ближайшее время."
+        else:
+            message = f"Запрос из категории '{category}' от @{username}:\n{text}"
+            request_id = await ledger.record(user_id, username, chat_id, category, text, list(photos) + list(documents), update_id=update_id)
+            recent_requests.put(key, request_id)
+            submitted = await send_to_group(context, message, photos, documents, username, request_id, category, source=source, chat_id=chat_id, update_id=update_id)
+            reply = (
+                f"✅ Ваш запрос #{request_id} отправлен поставщикам!\n\n"
+                "⚡ Будет обработан в ближайшее время.\n"
+                "📞 Мы свяжемся с вами для уточнения деталей."
+            )
+        if update_id is not None:
+            inbox.hold(update_id, outbox.delivered(update_id))
+            if not submitted and (await outbox.find(update_id))['confirmed']:
+                logger.info("Request from update %s already confirmed", update_id)
+                return
+    except Exception as e:
+        logger.error("%s request error: %s", 'Help' if kind == 'help' else 'Free', e)
+        # Неотправленный запрос можно повторить сразу
+        recent_requests.pop(key)
+        reply = "❌ Не удалось отправить запрос. Попробуйте позже."
+        update_id = None
+    await context.bot.send_message(chat_id=chat_id, text=reply, reply_markup=MAIN_KEYBOARD)
+    if update_id is not None:
+        await outbox.confirm(update_id)
+
+# Альбом приходит отдельным апдейтом на каждое фото. Части собираются по media_group_id,
+# и через ALBUM_WINDOW секунд после последней части весь альбом уходит одним запросом.
+ALBUM_WINDOW = 1.0
+albums = {}
+
+def add_album_part(album, message):
+    if message.photo:
+        album['photos'].append((message.message_id, message.photo[-1].file_id))
+    if message.document:
+        album['documents'].append((message.message_id, message.document.file_id))
+    if message.caption and not album['text']:
+        album['text'] = message.caption
+    album['last'] = time.monotonic()
+
+async def flush_album(context: ContextTypes.DEFAULT_TYPE, media_group_id):
+    album = albums[media_group_id]
+    while (wait := album['last'] + ALBUM_WINDOW - time.monotonic()) > 0:
+        await asyncio.sleep(wait)
+    try:
+        await submit_request(
+            context, album['chat_id'], album['user_id'], album['username'], album['kind'], album['category'], album['text'],
+            [file_id for _, file_id in sorted(album['photos'])],
+            [file_id for _, file_id in sorted(album['documents'])],
+            update_id=album['update_id']
+        )
+        if context.user_data.get('album') == media_group_id:
+            context.user_data.clear()
+    finally:
+        del albums[media_group_id]
+        if not album['sent'].done():
+            album['sent'].set_result(None)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data = context.user_data
     text = update.message.text or update.message.caption
     photo = update.message.photo
     document = update.message.document
     username = update.effective_user.username
-    logger.info(f"Received message from @{username}: {text}")
+    media_group_id = update.message.media_group_id
+    logger.info("Received message from @%s: %s", username, text)
+
+    # Следующая часть уже собираемого альбома. Её апдейт, как и первый, отмечается
+    # обработанным только после отправки альбома
+    if media_group_id and media_group_id in albums:
+        add_album_part(albums[media_group_id], update.message)
+        inbox.hold(update.update_id, albums[media_group_id]['sent'])
+        return
 
     if text and text.lower() == "отмена":
         await cancel_request(update, context)
         return
 
+    # Пока собирается альбом, другие сообщения пользователя новый запрос не начинают
+    if user_data.get('album') in albums:
+        return
+
     if user_data.get('help_request'):
+        kind = 'help'
         if not text and not photo and not document:
             await update.message.reply_text(
                 "📝 Пожалуйста, опишите проблему или предложение.",
-                reply_markup=get_cancel_keyboard()
+                reply_markup=CANCEL_KEYBOARD
             )
             return
-        message = f"Запрос помощи от @{username}:\n{text}"
-        try:
-            await send_to_group(context, message, photo, document, username)
-            await update.message.reply_text(
-                "✅ Ваш запрос помощи отправлен. Ожидайте ответа в ближайшее время.",
-                reply_markup=get_main_keyboard()
-            )
-        except Exception as e:
-            logger.error(f"Help request error: {e}")
-            await update.message.reply_text(
-                "❌ Не удалось отправить запрос. Попробуйте позже.",
-                reply_markup=get_main_keyboard()
-            )
-        user_data.clear()
-        return
-
-    if user_data.get('free_request'):
+    elif user_data.get('free_request'):
+        kind = 'request'
         if not text and not photo and not document:
             await update.message.reply_text(
                 "📝 Пожалуйста, добавьте описание, фото или документ к вашему запросу.",
-                reply_markup=get_cancel_keyboard()
+                reply_markup=CANCEL_KEYBOARD
             )
             return
-        request_id = int(time.time())
-        category = user_data.get('category', 'Неизвестно')
-        message = f"Запрос из категории '{category}' от @{username}:\n{text}"
-        try:
-            await send_to_group(context, message, photo, document, username, request_id, category)
-            await update.message.reply_text(
-                f"✅ Ваш запрос #{request_id} отправлен поставщикам!\n\n"
-                "⚡ Будет обработан в ближайшее время.\n"
-                "📞 Мы свяжемся с вами для уточнения деталей.",
-                reply_markup=get_main_keyboard()
-            )
-        except Exception as e:
-            logger.error(f"Free request error: {e}")
-            await update.message.reply_text(
-                "❌ Не удалось отправить запрос. Попробуйте позже.",
-                reply_markup=get_main_keyboard()
-            )
-        user_data.clear()
+    else:
         return
 
-# Запуск бота
-def run_bot():
-    logger.info("Starting Telegram bot...")
-    
-    application = Application.builder().token(TOKEN).build()
+    category = user_data.get('category', 'Неизвестно')
+
+    # user_data сбрасывается только после записи запроса: PTB сохраняет user_data в фоне,
+    # и сохранённое раньше пустое состояние после падения потеряло бы сообщение покупателя
+    if media_group_id:
+        user_data['album'] = media_group_id
+        albums[media_group_id] = {
+            'chat_id': update.message.chat_id,
+            'user_id': update.effective_user.id,
+            'username': username,
+            'kind': kind,
+            'category': category,
+            'text': None,
+            'photos': [],
+            'documents': [],
+            'update_id': update.update_id,
+            'sent': asyncio.get_running_loop().create_future(),
+        }
+        add_album_part(albums[media_group_id], update.message)
+        inbox.hold(update.update_id, albums[media_group_id]['sent'])
+        context.application.create_task(flush_album(context, media_group_id), update=update)
+        return
+
+    await submit_request(
+        context, update.message.chat_id, update.effective_user.id, username, kind, category, text,
+        [photo[-1].file_id] if photo else [],
+        [document.file_id] if document else [],
+        source=(update.message.chat_id, update.message.message_id),
+        update_id=update.update_id
+    )
+    user_data.clear()
+
+# Команды журнала запросов
+STATUS_NAMES = {'open': '🟢 открыт', 'closed': '✅ закрыт'}
+
+def format_request(item):
+    return (
+        f"Запрос #{item['id']} ({STATUS_NAMES.get(item['status'], item['status'])})\n"
+        f"📅 {time.strftime('%d.%m.%Y %H:%M', time.localtime(item['created_at']))}\n"
+        f"Категория: {item['category']}\n"
+        f"От: @{item['username'] or 'неизвестный'}\n"
+        f"{item['text'] or ''}"
+    )
+
+def parse_request_id(context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) != 1:
+        return None
+    try:
+        return int(context.args[0].lstrip('#'))
+    except ValueError:
+        return None
+
+# /request <номер> - поставщики смотрят запрос по номеру
+async def request_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    request_id = parse_request_id(context)
+    if request_id is None:
+        await update.message.reply_text("Использование: /request <номер запроса>")
+        return
+    item = await ledger.get(request_id)
+    if item is None:
+        await update.message.reply_text(f"Запрос #{request_id} не найден.")
+        return
+    await update.message.reply_text(format_request(item))
+
+# /close <номер> - поставщики закрывают обработанный запрос
+async def close_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    request_id = parse_request_id(context)
+    if request_id is None:
+        await update.message.reply_text("Использование: /close <номер запроса>")
+        return
+    if await ledger.get(request_id) is None:
+        await update.message.reply_text(f"Запрос #{request_id} не найден.")
+        return
+    ledger.set_status(request_id, 'closed')
+    await update.message.reply_text(f"✅ Запрос #{request_id} закрыт.")
+
+# /find <VIN, код детали или слова> - поставщики ищут похожие прошлые запросы
+FIND_LIMIT = 10
 
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = ' '.join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /find <VIN, код детали или слова из запроса>")
+        return
+    items = await ledger.search(query, limit=FIND_LIMIT)
+    if not items:
+        await update.message.reply_text(f"По запросу «{query}» ничего не найдено.")
+        return
+    lines = [
+        f"#{item['id']} {STATUS_NAMES.get(item['status'], item['status'])}, "
+        f"{time.strftime('%d.%m.%Y', time.localtime(item['created_at']))}, "
+        f"{item['category']}, @{item['username'] or 'неизвестный'}\n{item['snippet']}"
+        for item in items
+    ]
+    text = f"🔎 Найдено по запросу «{query}»:\n\n" + "\n\n".join(lines)
+    await update.message.reply_text(text[:4096])
+
+# /my_requests - покупатель видит свои открытые запросы
+async def my_requests_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    items = await ledger.list_for_user(update.effective_user.id)
+    if not items:
+        await update.message.reply_text("У вас нет открытых запросов.", reply_markup=MAIN_KEYBOARD)
+        return
+    text = "📋 Ваши открытые запросы:\n\n" + "\n\n".join(format_request(item) for item in items)
+    await update.message.reply_text(text[:4096], reply_markup=MAIN_KEYBOARD)
+
+# HTTP сервер: проверка живости для Render и приём вебхуков
+web_server = WebServer(PORT)
+
+async def health(headers, body):
+    return 200, 'text/plain', b'Bot is alive!'
+
+async def metrics_page(headers, body):
+    return 200, 'text/plain; version=0.0.4', metrics.render()
+
+def register_metrics(processor: PerUserUpdateProcessor):
+    metrics.gauge('bot_updates_in_flight', 'Updates being processed.', lambda: processor.in_flight)
+    metrics.gauge('bot_updates_pending', 'Updates waiting for processing.', lambda: processor.pending_updates)
+    metrics.gauge('bot_oldest_pending_update_age_seconds', 'Age of the oldest waiting update.', processor.oldest_pending_age)
+    metrics.gauge('bot_outbox_depth', 'Outbound queue depth.', lambda: outbox.stats['depth'])
+    metrics.gauge('bot_outbox_depth_request', 'Outbound queue depth, customer requests.', lambda: outbox.stats['depth_request'])
+    metrics.gauge('bot_outbox_depth_help', 'Outbound queue depth, help requests.', lambda: outbox.stats['depth_help'])
+    for name in ('sent', 'retried', 'failed', 'rejected', 'restored'):
+        metrics.counter(f'bot_outbox_{name}_total', f'Outbound messages {name}.', lambda name=name: outbox.stats[name])
+    for name in ('received', 'duplicates', 'replayed', 'throttled'):
+        metrics.counter(f'bot_inbox_{name}_total', f'Incoming updates {name}.', lambda name=name: inbox.stats[name])
+    metrics.counter('bot_duplicate_callbacks_total', 'Repeated button presses ignored.', lambda: recent_callbacks.hits)
+    metrics.counter('bot_duplicate_requests_total', 'Repeated customer requests ignored.', lambda: recent_requests.hits)
+    metrics.counter('bot_log_records_dropped_total', 'Log records dropped because the log queue was full.', lambda: log_handler.dropped)
+
+def make_webhook_handler(application: Application):
+    async def webhook(headers, body):
+        if headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return 403, 'text/plain', b'Forbidden'
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except ValueError:
+            return 400, 'text/plain', b'Bad Request'
+        # 200 отдаём только после записи в журнал, иначе Telegram повторит апдейт
+        await inbox.accept([update])
+        return 200, 'text/plain', b'OK'
+    return webhook
+
+# Приём пачки апдейтов от входного процесса (режим BOT_MODE=worker, см. shard.py)
+def make_shard_handler(application: Application):
+    async def shard_updates(headers, body):
+        try:
+            updates = [Update.de_json(data, application.bot) for data in json.loads(body)]
+        except (ValueError, TypeError):
+            return 400, 'text/plain', b'Bad Request'
+        # Как и у вебхука: 200 - апдейты в журнале, входной процесс может подтверждать их Telegram
+        await inbox.accept(updates)
+        return 200, 'text/plain', b'OK'
+    return shard_updates
+
+# Последствия обработанных апдейтов, которые должны быть в базе до отметки 'done' (см. UpdateInbox)
+async def commit_updates(application: Application):
+    await application.update_persistence()
+    await application.persistence.commit()
+    await ledger.sync()
+
+async def on_startup(application: Application):
+    await inbox.start(application, commit=lambda: commit_updates(application))
+    await ledger.start()
+    await outbox.start(application.bot)
+    # Прерванные рассылки продолжает только первый воркер пула, иначе их разослали бы все
+    await broadcaster.start(application.bot, shared_buckets=(outbox.global_bucket,), resume=SHARD_INDEX == 0)
+    await web_server.start()
+
+async def on_shutdown(application: Application):
+    await web_server.stop()
+    await broadcaster.stop()
+    await outbox.stop()
+    # Последние отметки апдейтов ещё пишут журнал запросов (commit_updates)
+    await inbox.stop()
+    await ledger.stop()
+    # Сворачиваем журнал новостей в news.json перед остановкой
+    await news_store.compact()
+
+def build_application():
+    processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, on_processed=inbox.done)
+    # Updater из PTB не нужен: апдейты получает inbox (long polling) или make_webhook_handler
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(BOT_API_URL)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(processor)
+        .persistence(SqlitePersistence(DB_PATH))
+        .updater(None)
+        .build()
+    )
+    add_handlers(application)
+
+    # Метрики: время и ошибки каждого обработчика и каждого вызова Bot API
+    metrics.instrument_application(application)
+    register_metrics(processor)
+
+    web_server.route('GET', '/', health)
+    web_server.route('GET', '/metrics', metrics_page)
+    web_server.route('POST', WEBHOOK_PATH, make_webhook_handler(application))
+    if BOT_MODE == 'worker':
+        web_server.route('POST', SHARD_PATH, make_shard_handler(application))
+    return application
+
+def add_handlers(application: Application):
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("my_requests", my_requests_command))
+    application.add_handler(CommandHandler("subscribe", subscribe_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("request", request_command, filters=filters.Chat(GROUP_ID)))
+    application.add_handler(CommandHandler("close", close_command, filters=filters.Chat(GROUP_ID)))
+    application.add_handler(CommandHandler("find", find_command, filters=filters.Chat(GROUP_ID)))
     application.add_handler(news_conv_handler)
 
     # Обработчики callback и сообщений
@@ -437,19 +770,55 @@ def run_bot():
     application.add_handler(MessageHandler(filters.PHOTO, handle_message))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_message))
 
-    # Запуск
-    logger.info("Bot starting polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+# Запуск в текущем event loop, одинаковый для polling, вебхука и воркера пула. run_polling/run_webhook из PTB
+# не используются: они подтверждают апдейты Telegram до обработки, а run_webhook ещё и требует tornado.
+# Порядок старта: журнал апдейтов прогоняется до приёма новых, затем polling или вебхук.
+# started - момент запуска процесса (см. main.py), от него считается время холодного старта.
+# Без WEBHOOK_URL вебхук в Telegram не регистрируется - удобно для локальной проверки:
+# curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json localhost:5000/webhook/$WEBHOOK_SECRET
+async def serve(application: Application, started=None):
+    started = started or time.perf_counter()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    logger.info("Cold start: %.2fs", time.perf_counter() - started)
+    await inbox.drain()
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        logger.info("Bot waiting for webhooks on port %s...", PORT)
+    elif BOT_MODE == 'worker':
+        logger.info("Worker %s of %s waiting for updates on port %s...", SHARD_INDEX, SHARD_COUNT, PORT)
+    else:
+        inbox.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Bot polling...")
+    try:
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать апдейты, потом дорабатываем принятые
+        await inbox.stop_polling()
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+# Запуск бота
+def run_bot(started=None):
+    logger.info("Starting Telegram bot...")
+    application = build_application()
+    asyncio.run(serve(application, started))
 
 def main():
     logger.info("Application starting...")
-    
-    # Запускаем HTTP сервер в отдельном потоке
-    health_thread = threading.Thread(target=run_health_server, daemon=True)
-    health_thread.start()
-    
-    # Запускаем бота в основном потоке
-    run_bot()
+    run_bot(time.perf_counter())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
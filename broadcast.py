@@ -0,0 +1,185 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+
+from ledger import connect
+from outbox import TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    user_id INTEGER PRIMARY KEY,
+    subscribed INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscribers_active ON subscribers (subscribed, user_id);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    news_id TEXT PRIMARY KEY,
+    text TEXT,
+    photo TEXT,
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'running',
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+"""
+
+
+# Рассылка новостей подписчикам.
+# Подписчики - пользователи, нажавшие /start в личке, с возможностью отписаться.
+# Каждая рассылка - фоновая задача: подписчики берутся пачками по user_id, внутри пачки
+# отправка идёт с ограниченной параллельностью и через token bucket (общий лимит Telegram ~30/с).
+# После каждой пачки в broadcasts сохраняется last_user_id, поэтому после перезапуска
+# рассылка продолжается с места остановки (повторно может уйти не больше одной пачки).
+# Заблокировавшие бота пользователи удаляются из подписчиков.
+class Broadcaster:
+    def __init__(self, path, rate=20, concurrency=8, batch_size=50, max_attempts=3):
+        self.path = path
+        self.bucket = TokenBucket(rate, rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.shared_buckets = ()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="broadcast")
+        self._conn = None
+        self._tasks = {}
+        self.bot = None
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _execute(self, sql, args=()):
+        with self._conn:
+            return self._conn.execute(sql, args).rowcount
+
+    def _fetch(self, sql, args=()):
+        return self._conn.execute(sql, args).fetchall()
+
+    async def start(self, bot, shared_buckets=(), resume=True):
+        # shared_buckets - лимиты, общие с остальными отправками бота (например, outbox.global_bucket)
+        self.bot = bot
+        self.shared_buckets = shared_buckets
+        await self._run(self._open)
+        if not resume:
+            return
+        for news_id, text, photo in await self._run(
+            self._fetch, "SELECT news_id, text, photo FROM broadcasts WHERE status = 'running'"
+        ):
+            logger.info("Продолжаем рассылку %s", news_id)
+            self._spawn(news_id, text, photo)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    # --- подписчики ---
+
+    async def subscribe(self, user_id, force=False):
+        # Без force уже отписавшийся пользователь остаётся отписанным
+        if force:
+            sql = "INSERT OR REPLACE INTO subscribers (user_id, subscribed, created_at) VALUES (?, 1, ?)"
+        else:
+            sql = "INSERT OR IGNORE INTO subscribers (user_id, subscribed, created_at) VALUES (?, 1, ?)"
+        await self._run(self._execute, sql, (user_id, time.time()))
+
+    async def unsubscribe(self, user_id):
+        await self._run(self._execute, "UPDATE subscribers SET subscribed = 0 WHERE user_id = ?", (user_id,))
+
+    async def subscriber_count(self):
+        rows = await self._run(self._fetch, "SELECT COUNT(*) FROM subscribers WHERE subscribed = 1")
+        return rows[0][0]
+
+    # --- рассылка ---
+
+    async def broadcast(self, news_id, text, photo=None):
+        await self._run(
+            self._execute,
+            "INSERT OR IGNORE INTO broadcasts (news_id, text, photo, created_at) VALUES (?, ?, ?, ?)",
+            (news_id, text, photo, time.time())
+        )
+        self._spawn(news_id, text, photo)
+
+    def _spawn(self, news_id, text, photo):
+        if news_id not in self._tasks:
+            task = asyncio.create_task(self._run_broadcast(news_id, text, photo))
+            self._tasks[news_id] = task
+            task.add_done_callback(lambda _: self._tasks.pop(news_id, None))
+
+    async def _send(self, user_id, text, photo):
+        # True - доставлено, False - не доставлено, None - пользователь заблокировал бота
+        for attempt in range(1, self.max_attempts + 1):
+            await self.bucket.acquire()
+            for bucket in self.shared_buckets:
+                await bucket.acquire()
+            try:
+                if photo:
+                    await self.bot.send_photo(chat_id=user_id, photo=photo, caption=text)
+                else:
+                    await self.bot.send_message(chat_id=user_id, text=text)
+                return True
+            except Forbidden:
+                return None
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return None
+                logger.error("Рассылка пользователю %s: %s", user_id, e)
+                return False
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+            except NetworkError:
+                await asyncio.sleep(attempt)
+        return False
+
+    async def _run_broadcast(self, news_id, text, photo):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(user_id):
+            async with semaphore:
+                return user_id, await self._send(user_id, text, photo)
+
+        try:
+            (last_user_id,) = (await self._run(
+                self._fetch, "SELECT last_user_id FROM broadcasts WHERE news_id = ?", (news_id,)
+            ))[0]
+            while True:
+                batch = [row[0] for row in await self._run(
+                    self._fetch,
+                    "SELECT user_id FROM subscribers WHERE subscribed = 1 AND user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_user_id, self.batch_size)
+                )]
+                if not batch:
+                    break
+                results = await asyncio.gather(*[send_one(user_id) for user_id in batch])
+                blocked = [(user_id,) for user_id, result in results if result is None]
+                sent = sum(1 for _, result in results if result)
+                failed = len(results) - sent - len(blocked)
+                last_user_id = batch[-1]
+                await self._run(self._checkpoint, news_id, last_user_id, sent, failed, blocked)
+            await self._run(self._execute, "UPDATE broadcasts SET status = 'done' WHERE news_id = ?", (news_id,))
+            logger.info("Рассылка %s завершена", news_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Рассылка %s прервана: %s", news_id, e)
+
+    def _checkpoint(self, news_id, last_user_id, sent, failed, blocked):
+        with self._conn:
+            self._conn.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ? WHERE news_id = ?",
+                (last_user_id, sent, failed, news_id)
+            )
+            self._conn.executemany("DELETE FROM subscribers WHERE user_id = ?", blocked)
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+
+
+# Кэш недавних действий пользователей для отсечения повторов (двойное нажатие кнопки,
+# повторная отправка того же запроса). Запись живёт ttl секунд, всего записей не больше maxsize:
+# при переполнении вытесняются самые старые. Записи лежат в порядке добавления,
+# поэтому и устаревшие, и вытесняемые снимаются с начала за O(1).
+class DedupCache:
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items = OrderedDict()   # ключ -> (время добавления, значение)
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _expire(self, now):
+        while self._items:
+            key, (added, _) = next(iter(self._items.items()))
+            if now - added < self.ttl:
+                break
+            del self._items[key]
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        self._expire(now)
+        item = self._items.get(key)
+        if item is None:
+            return default
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value=True):
+        now = time.monotonic()
+        self._expire(now)
+        # Повторное добавление переносит запись в конец и продлевает её
+        self._items.pop(key, None)
+        self._items[key] = (now, value)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        self._items.pop(key, None)
+
+    def repeated(self, key, value):
+        # True, если последнее значение под ключом в окне ttl равно value; иначе запоминает value
+        now = time.monotonic()
+        self._expire(now)
+        item = self._items.get(key)
+        if item is not None and item[1] == value:
+            self.hits += 1
+            return True
+        self.put(key, value)
+        return False
+
+    def seen(self, key):
+        # True, если ключ уже был в окне ttl; иначе запоминает его
+        if self.get(key) is not None:
+            return True
+        self.put(key)
+        return False
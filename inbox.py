@@ -0,0 +1,295 @@
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.error import TelegramError, RetryAfter, NetworkError
+
+from ledger import connect
+from outbox import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS updates_pending ON updates (status, update_id);
+"""
+
+
+# Журнал входящих апдейтов: ни один апдейт не теряется при перезапуске и не обрабатывается дважды.
+# - Апдейт сначала записывается в таблицу updates (status = 'pending') и только потом
+#   подтверждается Telegram: в режиме polling - offset следующего getUpdates, в режиме вебхука - ответ 200.
+#   Поэтому вместо drop_pending_updates при старте забираются все накопившиеся апдейты.
+# - После обработки апдейт помечается 'done' (пачкой, как в журнале запросов), но только когда
+#   его последствия уже в базе: перед отметкой вызывается commit (в bot.py - запись user_data,
+#   состояний диалогов и журнала запросов), а апдейт, для которого вызван hold(update_id, until),
+#   ждёт ещё и until - доставки запроса в группу или сборки альбома. Иначе после SIGKILL
+#   апдейт, отмеченный обработанным, не повторится, а его состояние или сообщение в группу пропадут.
+# - При старте незавершённые апдейты из журнала прогоняются заново пачками по drain_batch,
+#   и только потом начинается приём новых, чтобы апдейты одного пользователя шли по порядку.
+# - Повторы отсекаются по update_id: уже записанный апдейт (повтор вебхука, ответ getUpdates
+#   после перезапуска) в очередь не попадает. Обработанные апдейты хранятся keep секунд.
+# - Если журнал общий для нескольких процессов (режим с воркерами, см. shard.py), owns(JSON апдейта)
+#   говорит, какие незавершённые апдейты прогоняет этот процесс.
+# - Backpressure: когда отданных в обработку и ещё не обработанных апдейтов max_pending,
+#   accept ждёт, пока освободится место. Вебхук и воркер пула дольше не отвечают 200,
+#   polling не запрашивает следующую пачку, так что update_queue и задачи PTB не растут без предела.
+class UpdateInbox:
+    def __init__(self, path, drain_batch=100, flush_interval=0.2, keep=24 * 3600, poll_timeout=30, owns=None,
+                 max_pending=1000):
+        self.path = path
+        self.owns = owns
+        self.max_pending = max_pending
+        self.drain_batch = drain_batch
+        self.flush_interval = flush_interval
+        self.keep = keep
+        self.poll_timeout = poll_timeout
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="inbox")
+        self._conn = None
+        self._done = []
+        self._flush_task = None
+        self._queued = set()     # update_id, уже отданные в update_queue и ещё не обработанные
+        self._holds = {}         # update_id -> сколько hold ещё не завершилось
+        self._finished = set()   # обработанные апдейты, которые ещё держит hold
+        self._hold_tasks = set()
+        self.commit = None
+        self._room = asyncio.Event()   # в обработке меньше max_pending апдейтов
+        self._room.set()
+        self._poller = None
+        self.application = None
+        self.ready = False       # журнал прогнан, новые апдейты можно сразу отдавать в обработку
+        self.offset = None
+        self.stats = {'received': 0, 'duplicates': 0, 'replayed': 0, 'throttled': 0}
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        (last,) = self._conn.execute("SELECT MAX(update_id) FROM updates").fetchone()
+        return None if last is None else last + 1
+
+    async def start(self, application, commit=None):
+        self.application = application
+        self.commit = commit
+        self.offset = await self._run(self._open)
+
+    async def stop(self):
+        await self.stop_polling()
+        # Недождавшиеся апдейты не отмечаем: после перезапуска они прогонятся заново
+        for task in list(self._hold_tasks):
+            task.cancel()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write_done()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    # --- запись ---
+
+    def _insert(self, rows):
+        # Возвращает update_id, которых ещё не было в журнале
+        fresh = []
+        with self._conn:
+            for update_id, data in rows:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO updates (update_id, data, received_at) VALUES (?, ?, ?)",
+                    (update_id, data, time.time())
+                )
+                if cursor.rowcount:
+                    fresh.append(update_id)
+        return fresh
+
+    async def accept(self, updates):
+        # Записывает апдейты в журнал и отдаёт новые в обработку. Подтверждать апдейт
+        # Telegram можно только после того, как accept вернул управление.
+        rows = [(update.update_id, json.dumps(update.to_dict(), ensure_ascii=False)) for update in updates]
+        fresh = set(await self._run(self._insert, rows))
+        self.stats['received'] += len(fresh)
+        self.stats['duplicates'] += len(updates) - len(fresh)
+        if self.ready:
+            for update in updates:
+                if update.update_id in fresh:
+                    await self._enqueue(update)
+
+    async def _enqueue(self, update):
+        if len(self._queued) >= self.max_pending:
+            self.stats['throttled'] += 1
+            while len(self._queued) >= self.max_pending:
+                self._room.clear()
+                await self._room.wait()
+        if update.update_id in self._queued:
+            return
+        self._queued.add(update.update_id)
+        await self.application.update_queue.put(update)
+
+    def done(self, update):
+        # Вызывается обработчиком апдейтов после каждого апдейта, в том числе завершившегося ошибкой:
+        # апдейт, который роняет обработчик, не должен повторяться после каждого перезапуска
+        update_id = getattr(update, 'update_id', None)
+        if update_id is None or update_id not in self._queued:
+            return
+        self._queued.discard(update_id)
+        if len(self._queued) < self.max_pending:
+            self._room.set()
+        if update_id in self._holds:
+            self._finished.add(update_id)
+        else:
+            self._mark(update_id)
+
+    def hold(self, update_id, until):
+        # Апдейт не отмечается обработанным, пока не завершится until (корутина или future)
+        self._holds[update_id] = self._holds.get(update_id, 0) + 1
+        task = asyncio.ensure_future(until)
+        self._hold_tasks.add(task)
+        task.add_done_callback(lambda task: self._release(update_id, task))
+
+    def _release(self, update_id, task):
+        self._hold_tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error("Ожидание для апдейта %s завершилось ошибкой: %s", update_id, task.exception())
+        self._holds[update_id] -= 1
+        if self._holds[update_id]:
+            return
+        del self._holds[update_id]
+        if update_id in self._finished:
+            self._finished.discard(update_id)
+            self._mark(update_id)
+
+    def _mark(self, update_id):
+        self._done.append(update_id)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _mark_done(self, update_ids):
+        with self._conn:
+            self._conn.executemany("UPDATE updates SET status = 'done' WHERE update_id = ?", [(i,) for i in update_ids])
+            # Последний апдейт не удаляем: по нему восстанавливается offset
+            self._conn.execute(
+                "DELETE FROM updates WHERE status = 'done' AND received_at < ? "
+                "AND update_id < (SELECT MAX(update_id) FROM updates)",
+                (time.time() - self.keep,)
+            )
+
+    async def _write_done(self):
+        if not self._done or self._conn is None:
+            return True
+        update_ids, self._done = self._done, []
+        try:
+            if self.commit is not None:
+                await self.commit()
+            await self._run(self._mark_done, update_ids)
+        except Exception as e:
+            logger.error("Не удалось отметить %s обработанных апдейтов: %s", len(update_ids), e)
+            self._done = update_ids + self._done
+            return False
+        return True
+
+    async def _flush_later(self):
+        # Отметки, появившиеся во время записи, уходят следующей пачкой
+        while self._done:
+            await asyncio.sleep(self.flush_interval)
+            if not await self._write_done():
+                return
+
+    # --- прогон журнала при старте ---
+
+    def _select_pending(self, after, limit):
+        return self._conn.execute(
+            "SELECT update_id, data FROM updates WHERE status = 'pending' AND update_id > ? "
+            "ORDER BY update_id LIMIT ?",
+            (after, limit)
+        ).fetchall()
+
+    async def drain(self):
+        # Вызывать после application.start(): апдейты пачками отдаются в update_queue,
+        # следующая пачка читается, когда предыдущая разобрана по обработчикам
+        queue = self.application.update_queue
+        started = time.perf_counter()
+        after = -1
+        while True:
+            rows = await self._run(self._select_pending, after, self.drain_batch)
+            if not rows:
+                break
+            after = rows[-1][0]
+            updates = [json.loads(data) for _, data in rows]
+            if self.owns is not None:
+                updates = [update for update in updates if self.owns(update)]
+            for update in updates:
+                await self._enqueue(Update.de_json(update, self.application.bot))
+            self.stats['replayed'] += len(updates)
+            await queue.join()
+        self.ready = True
+        if self.stats['replayed']:
+            logger.info(
+                "Из журнала повторно обработано апдейтов: %s за %.2f с",
+                self.stats['replayed'], time.perf_counter() - started
+            )
+
+    # --- long polling ---
+
+    def start_polling(self, allowed_updates=Update.ALL_TYPES):
+        self._poller = asyncio.create_task(self._poll(allowed_updates))
+
+    async def stop_polling(self):
+        if self._poller is None:
+            return
+        self._poller.cancel()
+        await asyncio.gather(self._poller, return_exceptions=True)
+        self._poller = None
+
+    async def _poll(self, allowed_updates):
+        # Любая ошибка повторяется с паузой: задача polling не должна завершиться, пока бот работает,
+        # иначе апдейты перестанут приходить, а проверка живости будет отвечать как обычно
+        bot = self.application.bot
+        webhook_deleted = False
+        updates = []             # пачка, ещё не записанная в журнал: повторяется без сдвига offset
+        delay = 1
+        while True:
+            method = "getUpdates"
+            try:
+                if not webhook_deleted:
+                    # getUpdates не работает, пока установлен вебхук; накопившиеся апдейты не сбрасываем
+                    method = "deleteWebhook"
+                    await bot.delete_webhook(drop_pending_updates=False)
+                    webhook_deleted = True
+                    method = "getUpdates"
+                if not updates:
+                    updates = await bot.get_updates(
+                        offset=self.offset, timeout=self.poll_timeout, allowed_updates=allowed_updates
+                    )
+                if updates:
+                    method = "журнал апдейтов"
+                    await self.accept(updates)
+                    # Следующий getUpdates с этим offset подтвердит апдейты, они уже в журнале
+                    self.offset = updates[-1].update_id + 1
+                    updates = []
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+                continue
+            except NetworkError as e:
+                logger.warning("%s: %s, повтор через %s с", method, e, delay)
+            except TelegramError as e:
+                # Например, Conflict: запущен второй экземпляр бота
+                logger.error("%s: %s", method, e)
+                await asyncio.sleep(self.poll_timeout)
+                continue
+            except Exception as e:
+                # Например, "database is locked": пачка не записана и не подтверждена Telegram
+                logger.error("%s: %s, повтор через %s с", method, e, delay)
+            else:
+                delay = 1
+                continue
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
@@ -0,0 +1,331 @@
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    username TEXT,
+    chat_id INTEGER,
+    category TEXT,
+    text TEXT,
+    file_ids TEXT,
+    status TEXT NOT NULL DEFAULT 'open',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    update_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS requests_by_user ON requests (user_id, status, id);
+CREATE INDEX IF NOT EXISTS requests_by_category ON requests (category, id);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5 (
+    text, username, category, codes,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+COLUMNS = (
+    "id", "user_id", "username", "chat_id", "category", "text", "file_ids", "status", "created_at", "updated_at", "update_id"
+)
+
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def row_to_dict(row):
+    if row is None:
+        return None
+    item = dict(zip(COLUMNS, row))
+    item["file_ids"] = json.loads(item["file_ids"] or "[]")
+    return item
+
+
+# Разделители внутри VIN, номеров кузова и кодов запчастей: "WDB-211.042", "A 000 420 17 20"
+CODE_SEPARATORS = re.compile(r'[-./_\\]')
+WORD = re.compile(r'\w+')
+
+
+def normalize_code(chunk):
+    return CODE_SEPARATORS.sub('', chunk).lower()
+
+
+def is_code(token):
+    return len(token) >= 4 and any(c.isdigit() for c in token)
+
+
+# Коды из текста запроса в нормализованном виде: без разделителей и в нижнем регистре.
+# Соседние куски кода склеиваются ("A 000 420 17 20" -> "a0004201720", "0004201720", ...),
+# чтобы код находился как бы его ни записали.
+def extract_codes(text):
+    if not text:
+        return ''
+    codes = []
+    runs = [[]]
+    for chunk in text.split():
+        token = normalize_code(chunk.strip(',;:()[]"\''))
+        if token.isalnum() and (any(c.isdigit() for c in token) or (len(token) <= 3 and token.isascii())):
+            runs[-1].append(token)
+        elif runs[-1]:
+            runs.append([])
+    for run in runs:
+        for start in range(len(run)):
+            for code in (run[start], ''.join(run[start:])):
+                if is_code(code) and code not in codes:
+                    codes.append(code)
+    return ' '.join(codes)
+
+
+# Запрос /find -> выражение FTS5. Коды ищутся по колонке codes в нормализованном виде
+# и как обычное слово по всем колонкам (похожее на код слово может быть именем пользователя: user5),
+# остальные слова - по всем колонкам, везде поиск по префиксу.
+def build_match(query):
+    terms = []
+    compact = normalize_code(''.join(query.split()).lstrip('#'))
+    for chunk in query.split():
+        token = normalize_code(chunk.lstrip('#'))
+        if token.isalnum() and is_code(token):
+            terms.append(f'(codes : "{token}"* OR "{token}"*)')
+        else:
+            terms.extend(f'"{word}"*' for word in WORD.findall(chunk.lower()))
+    # Код, разбитый пробелами в самом запросе, тоже должен находиться целиком
+    if len(query.split()) > 1 and compact.isalnum() and is_code(compact):
+        return f'({" AND ".join(terms)}) OR codes : "{compact}"*' if terms else f'codes : "{compact}"*'
+    return ' AND '.join(terms)
+
+
+# Журнал запросов покупателей в SQLite.
+# Для поиска поставщиками (/find) текст запросов индексируется в FTS5-таблице requests_fts
+# (rowid = номер запроса), коды и VIN дополнительно хранятся нормализованными в колонке codes.
+# Номера запросов берутся блоками из таблицы counters, поэтому не совпадают даже у запросов
+# из одной секунды и не повторяются после перезапуска.
+# Все записи идут через одну задачу-писателя: она собирает накопившиеся изменения
+# и коммитит их пачкой в отдельном потоке, event loop не ждёт fsync.
+# Ещё не записанные запросы лежат в self._pending, чтобы чтение сразу их видело.
+# record возвращает номер, когда строка уже записана (номер сразу уходит покупателю и в группу),
+# sync ждёт записи всего, что поставлено в очередь до него. Пока кто-то ждёт, писатель не делает паузу.
+# update_id - апдейт, из которого создан запрос: повторный record из того же апдейта
+# (апдейт прогоняется заново после перезапуска, см. UpdateInbox) возвращает уже записанный номер.
+class RequestLedger:
+    ID_BLOCK = 100
+
+    def __init__(self, path, batch_size=200, flush_interval=0.2, max_backoff=30):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="ledger")
+        self._read_executor = ThreadPoolExecutor(1, thread_name_prefix="ledger-read")
+        self._conn = None        # соединение писателя, используется только из self._executor
+        self._read_conn = None   # соединение для чтения, только из self._read_executor
+        self._queue = None
+        self._writer = None
+        self._pending = {}
+        self._next_id = 0
+        self._id_limit = 0
+        self._id_lock = None
+        self._syncs = 0          # сколько sync ждут записи
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _read(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._read_executor, func, *args)
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        # Журнал, созданный до появления колонки update_id
+        if "update_id" not in [row[1] for row in self._conn.execute("PRAGMA table_info(requests)")]:
+            self._conn.execute("ALTER TABLE requests ADD COLUMN update_id INTEGER")
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS requests_by_update ON requests (update_id)")
+        self._conn.create_function("extract_codes", 1, extract_codes, deterministic=True)
+        # Запросы, записанные до появления поискового индекса
+        self._conn.execute(
+            "INSERT INTO requests_fts (rowid, text, username, category, codes) "
+            "SELECT id, text, username, category, extract_codes(text) FROM requests "
+            "WHERE id NOT IN (SELECT rowid FROM requests_fts)"
+        )
+        self._conn.commit()
+
+    def _reserve_ids(self):
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('request_id', 0)")
+            self._conn.execute("UPDATE counters SET value = value + ? WHERE name = 'request_id'", (self.ID_BLOCK,))
+            (limit,) = self._conn.execute("SELECT value FROM counters WHERE name = 'request_id'").fetchone()
+        return limit
+
+    def _write(self, batch):
+        with self._conn:
+            for op, args in batch:
+                if op == "sync":
+                    continue
+                if op == "insert":
+                    cursor = self._conn.execute(
+                        f"INSERT OR IGNORE INTO requests ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                        args
+                    )
+                    if not cursor.rowcount:
+                        continue
+                    # Поисковый индекс пополняется в той же транзакции
+                    request_id, _, username, _, category, text = args[:6]
+                    self._conn.execute(
+                        "INSERT INTO requests_fts (rowid, text, username, category, codes) VALUES (?, ?, ?, ?, ?)",
+                        (request_id, text, username, category, extract_codes(text))
+                    )
+                else:
+                    self._conn.execute("UPDATE requests SET status = ?, updated_at = ? WHERE id = ?", args)
+
+    async def start(self):
+        await self._run(self._open)
+        self._read_conn = await self._read(connect, self.path)
+        self._queue = asyncio.Queue()
+        self._id_lock = asyncio.Lock()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        if self._writer is None:
+            return
+        await self._queue.put(None)
+        await self._writer
+        self._writer = None
+        await self._run(self._conn.close)
+        await self._read(self._read_conn.close)
+        self._executor.shutdown()
+        self._read_executor.shutdown()
+
+    async def _write_batch(self, batch):
+        # Номера этих запросов уже отправлены покупателям, поэтому пачка не выбрасывается:
+        # при ошибке (например, "database is locked", когда bot.db пишут несколько процессов)
+        # она повторяется с backoff, а до записи запросы остаются в self._pending
+        delay = self.flush_interval
+        while True:
+            try:
+                await self._run(self._write, batch)
+                return
+            except Exception as e:
+                logger.error(
+                    "Не удалось записать %s изменений в журнал запросов: %s, повтор через %.1f с", len(batch), e, delay
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    async def _write_loop(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            # Небольшая пауза, чтобы в пачку попали соседние запросы
+            if not self._syncs:
+                await asyncio.sleep(self.flush_interval)
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+            for op, args in batch:
+                if op == "insert":
+                    self._pending.pop(args[0], None)
+                elif op == "sync" and not args.done():
+                    args.set_result(None)
+            if stop:
+                return
+
+    async def next_id(self):
+        async with self._id_lock:
+            if self._next_id >= self._id_limit:
+                limit = await self._run(self._reserve_ids)
+                self._next_id, self._id_limit = limit - self.ID_BLOCK, limit
+            self._next_id += 1
+            return self._next_id
+
+    async def sync(self):
+        future = asyncio.get_running_loop().create_future()
+        self._syncs += 1
+        try:
+            self._queue.put_nowait(("sync", future))
+            await future
+        finally:
+            self._syncs -= 1
+
+    async def record(self, user_id, username, chat_id, category, text, file_ids, update_id=None):
+        if update_id is not None:
+            row = await self._read(self._select_by_update, update_id)
+            if row is not None:
+                return row[0]
+        request_id = await self.next_id()
+        now = time.time()
+        row = (request_id, user_id, username, chat_id, category, text, json.dumps(file_ids), "open", now, now, update_id)
+        self._pending[request_id] = row
+        self._queue.put_nowait(("insert", row))
+        await self.sync()
+        return request_id
+
+    def set_status(self, request_id, status):
+        pending = self._pending.get(request_id)
+        if pending is not None:
+            self._pending[request_id] = pending[:7] + (status,) + pending[8:]
+        self._queue.put_nowait(("status", (status, time.time(), request_id)))
+
+    def _select_one(self, request_id):
+        return self._read_conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM requests WHERE id = ?", (request_id,)
+        ).fetchone()
+
+    def _select_by_update(self, update_id):
+        return self._read_conn.execute("SELECT id FROM requests WHERE update_id = ?", (update_id,)).fetchone()
+
+    def _select_by_user(self, user_id, status, limit):
+        return self._read_conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM requests WHERE user_id = ? AND status = ? ORDER BY id DESC LIMIT ?",
+            (user_id, status, limit)
+        ).fetchall()
+
+    def _search(self, match, limit):
+        return self._read_conn.execute(
+            "SELECT r.id, r.username, r.category, r.status, r.created_at, "
+            "snippet(requests_fts, 0, '[', ']', '…', 12) "
+            "FROM requests_fts JOIN requests r ON r.id = requests_fts.rowid "
+            "WHERE requests_fts MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit)
+        ).fetchall()
+
+    # Полнотекстовый поиск по записанным запросам (незаписанные появятся через flush_interval)
+    async def search(self, query, limit=10):
+        match = build_match(query)
+        if not match:
+            return []
+        rows = await self._read(self._search, match, limit)
+        keys = ("id", "username", "category", "status", "created_at", "snippet")
+        return [dict(zip(keys, row)) for row in rows]
+
+    async def get(self, request_id):
+        if request_id in self._pending:
+            return row_to_dict(self._pending[request_id])
+        return row_to_dict(await self._read(self._select_one, request_id))
+
+    async def list_for_user(self, user_id, status="open", limit=10):
+        # Снимок незаписанных берём до чтения из базы, иначе запись, закоммиченная между ними, потеряется
+        pending = [row for row in self._pending.values() if row[1] == user_id and row[7] == status]
+        rows = await self._read(self._select_by_user, user_id, status, limit)
+        found = {row[0] for row in rows}
+        rows = sorted(rows + [row for row in pending if row[0] not in found], reverse=True)[:limit]
+        return [row_to_dict(row) for row in rows]
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# Контекст апдейта, который попадает в каждую запись лога: задаётся в PerUserUpdateProcessor
+# (update_id, пользователь, начало обработки) и в Metrics.instrument (имя обработчика)
+update_id_var = contextvars.ContextVar('update_id', default=None)
+user_id_var = contextvars.ContextVar('user_id', default=None)
+handler_var = contextvars.ContextVar('handler', default=None)
+started_var = contextvars.ContextVar('update_started', default=None)
+
+# Формат записи и уровень: LOG_FORMAT=json|text, LOG_LEVEL=INFO
+# Выборка для частых записей уровня INFO и ниже: LOG_SAMPLE="httpx=0.01,bot=0.5" -
+# доля записей, которая остаётся от логгера и его потомков. WARNING и выше пишутся всегда.
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', 'httpx=0.01')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def bind_update(update):
+    # Возвращает токены для reset_update
+    user = getattr(update, 'effective_user', None)
+    return (
+        update_id_var.set(getattr(update, 'update_id', None)),
+        user_id_var.set(user.id if user is not None else None),
+        started_var.set(time.perf_counter()),
+    )
+
+
+def reset_update(tokens):
+    for var, token in zip((update_id_var, user_id_var, started_var), tokens):
+        var.reset(token)
+
+
+def parse_sample(spec):
+    rates = {}
+    for part in spec.split(','):
+        name, _, rate = part.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}   # имя логгера -> доля (с учётом родителей)
+
+    def rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split('.')
+            for i in range(len(parts), 0, -1):
+                prefix = '.'.join(parts[:i])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+# Кладёт запись в очередь, не дожидаясь вывода. Форматирование (record.getMessage, traceback)
+# происходит уже в потоке QueueListener, здесь только снимается контекст апдейта.
+# Если очередь заполнена (вывод не успевает), запись отбрасывается и учитывается в dropped.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.update_id = update_id_var.get()
+        record.user_id = user_id_var.get()
+        record.handler = handler_var.get()
+        started = started_var.get()
+        record.duration_ms = None if started is None else round((time.perf_counter() - started) * 1000, 1)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+queue_handler = None
+listener = None
+
+
+def setup_logging():
+    # Повторный вызов (main.py, затем bot.py) ничего не меняет
+    global queue_handler, listener
+    if queue_handler is not None:
+        return queue_handler
+    sink = logging.StreamHandler(sys.stderr)
+    sink.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SampleFilter(parse_sample(LOG_SAMPLE)))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(queue_handler.queue, sink, respect_handler_level=True)
+    listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return queue_handler
@@ -0,0 +1,48 @@
+# Точка входа с быстрым стартом (python main.py): порт открывается до импорта telegram и bot.py,
+# поэтому проверка живости Render проходит, пока бот импортируется и инициализируется.
+# Пока бот не готов, / отвечает "Starting", вебхук - 404 (Telegram повторит апдейт позже).
+# С SHARD_WORKERS=N (N > 1) этот процесс становится входным и запускает N воркеров, см. shard.py.
+import time
+
+STARTED = time.perf_counter()
+
+import os
+import asyncio
+import importlib
+
+from web import WebServer
+from logs import setup_logging
+
+PORT = int(os.environ.get("PORT", 5000))
+
+
+async def starting(headers, body):
+    return 200, 'text/plain', b'Starting'
+
+
+async def boot():
+    web_server = WebServer(PORT)
+    web_server.route('GET', '/', starting)
+    await web_server.start()
+    opened = time.perf_counter()
+
+    # Тяжёлые импорты - в отдельном потоке, чтобы event loop успевал отвечать на проверки живости
+    bot = await asyncio.to_thread(importlib.import_module, 'bot')
+    bot.logger.info("Port opened in %.2fs, bot imported in %.2fs", opened - STARTED, time.perf_counter() - opened)
+    import shard
+    if shard.SHARD_WORKERS > 1:
+        # Входной процесс берёт из bot.py только настройки, обработчики работают в воркерах
+        ingress = shard.Ingress(
+            bot.TOKEN, bot.BOT_API_URL, web_server, shard.SHARD_WORKERS,
+            int(os.getenv('SHARD_BASE_PORT', PORT + 1))
+        )
+        await ingress.run(bot.BOT_MODE, bot.WEBHOOK_URL, bot.WEBHOOK_PATH, bot.WEBHOOK_SECRET)
+        return
+    # bot.py регистрирует свои маршруты на уже запущенном сервере
+    bot.web_server = web_server
+    await bot.serve(bot.build_application(), STARTED)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    asyncio.run(boot())
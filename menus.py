@@ -0,0 +1,83 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Все меню бота описаны здесь таблицами и собираются один раз при импорте.
+# InlineKeyboardMarkup неизменяемый, поэтому готовые клавиатуры можно отдавать в каждый ответ.
+
+# Главное меню: (текст кнопки, callback_data)
+MAIN_MENU = (
+    ("1. 🛍️ Выбор товара", "product_selection"),
+    ("2. ❓ Помощь", "help"),
+    ("3. 📞 Контакты", "contacts"),
+    ("4. 📢 Новости/Отгрузки", "news_feed"),
+)
+
+AUTO_HINTS = (
+    "🔍 Рекомендации для быстрого поиска:\n"
+    "• VIN номер\n"
+    "• Номер кузова\n"
+    "• Марка и модель\n"
+    "• Год выпуска\n"
+    "• Код запчасти\n\n"
+    "📝 Опишите ваш запрос или приложите фото:"
+)
+
+DEFAULT_HINTS = (
+    "🔍 Рекомендации для быстрого поиска:\n"
+    "• Код товара или артикул\n"
+    "• Фотографии товара\n"
+    "• Видео обзор\n"
+    "• Технические характеристики\n\n"
+    "📝 Опишите ваш запрос или приложите фото:"
+)
+
+# Категории товаров: (ключ, название, подсказка). Новая категория - одна строка здесь.
+CATEGORIES = (
+    ("auto", "🚗 Автомобильные товары", AUTO_HINTS),
+    ("moto", "🏍️ Мотоциклы и питбайки", DEFAULT_HINTS),
+    ("toys", "🧸 Игрушки", DEFAULT_HINTS),
+    ("bags", "👜 Сумки", DEFAULT_HINTS),
+    ("clothes", "👕 Одежда", DEFAULT_HINTS),
+    ("sport", "⚽ Спортивный инвентарь", DEFAULT_HINTS),
+    ("electronics", "📱 Электроника", DEFAULT_HINTS),
+    ("appliances", "🏠 Бытовая техника", DEFAULT_HINTS),
+    ("decor", "🏠 Домашний декор", DEFAULT_HINTS),
+    ("beauty", "💄 Красота и здоровье", DEFAULT_HINTS),
+    ("jewelry", "💍 Ювелирка и аксессуары", DEFAULT_HINTS),
+    ("tools", "🛠️ Инструменты и оборудование", DEFAULT_HINTS),
+    ("office", "📊 Офисные товары", DEFAULT_HINTS),
+    ("kids", "🧒 Детские товары", DEFAULT_HINTS),
+    ("machinery", "⚙️ Станки и механизмы", DEFAULT_HINTS),
+    ("other_items", "📦 Другие товары", DEFAULT_HINTS),
+)
+CATEGORY_PREFIX = "category_"
+UNKNOWN_CATEGORY = "📦 Неизвестная категория"
+
+CONTACTS_TEXT = (
+    "📞 Наши контакты:\n\n"
+    "🌐 Сайт: yuemo-logistics.ru\n"
+    "📱 WhatsApp: +86 153 2332 5277\n"
+    "✉️ Email: info@yuemo-logistics.ru\n\n"
+    "🕒 Время работы: 24/7"
+)
+
+BACK_BUTTON = InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
+
+MAIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data)] for text, data in MAIN_MENU])
+
+# Категории по 2 в ряд и кнопка "Назад" в главное меню
+CATEGORIES_KEYBOARD = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(title, callback_data=CATEGORY_PREFIX + key) for key, title, _ in CATEGORIES[i:i + 2]]
+        for i in range(0, len(CATEGORIES), 2)
+    ] + [[BACK_BUTTON]]
+)
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+BACK_KEYBOARD = InlineKeyboardMarkup([[BACK_BUTTON]])
+
+# callback_data категории -> (название, готовый текст ответа)
+CATEGORY_BY_CALLBACK = {
+    CATEGORY_PREFIX + key: (title, f"Вы выбрали: {title}\n\n{hints}")
+    for key, title, hints in CATEGORIES
+}
+UNKNOWN_CATEGORY_REPLY = (UNKNOWN_CATEGORY, f"Вы выбрали: {UNKNOWN_CATEGORY}\n\n{DEFAULT_HINTS}")
@@ -0,0 +1,167 @@
+import time
+import bisect
+import functools
+from telegram.request import HTTPXRequest
+
+from logs import handler_var
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_CALLBACK_LABELS = 1000
+
+
+# Гистограмма в формате Prometheus. Счётчики по корзинам выделяются один раз при создании,
+# observe только увеличивает числа в готовом списке.
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+def callback_label(data):
+    # news_page_3 -> news_page, чтобы число меток не росло вместе с номерами страниц
+    return data.rstrip('0123456789').rstrip('_') or data
+
+
+class Metrics:
+    def __init__(self):
+        self.handlers = {}       # имя обработчика -> Histogram
+        self.callbacks = {}      # метка callback_data -> Histogram
+        self._callback_cache = {}  # сырое callback_data -> Histogram
+        self.api_calls = {}      # метод Bot API -> Histogram
+        self.errors = {}         # (источник, имя, тип исключения) -> число
+        self.samples = {}        # имя -> (тип, описание, функция без аргументов)
+
+    def handler_histogram(self, name):
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram()
+        return histogram
+
+    def callback_histogram(self, data):
+        histogram = self._callback_cache.get(data)
+        if histogram is None:
+            label = callback_label(data)
+            histogram = self.callbacks.get(label)
+            if histogram is None:
+                histogram = self.callbacks[label] = Histogram()
+            if len(self._callback_cache) < MAX_CALLBACK_LABELS:
+                self._callback_cache[data] = histogram
+        return histogram
+
+    def api_histogram(self, method):
+        histogram = self.api_calls.get(method)
+        if histogram is None:
+            histogram = self.api_calls[method] = Histogram()
+        return histogram
+
+    def count_error(self, source, name, error):
+        key = (source, name, type(error).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    # Значения, которые считаются в момент запроса /metrics
+    def gauge(self, name, help_text, func):
+        self.samples[name] = ('gauge', help_text, func)
+
+    def counter(self, name, help_text, func):
+        self.samples[name] = ('counter', help_text, func)
+
+    # Обёртка для callback обработчика PTB: время выполнения и ошибки
+    def instrument(self, callback, name=None):
+        name = name or callback.__name__
+        histogram = self.handler_histogram(name)
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            token = handler_var.set(name)
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                self.count_error('handler', name, e)
+                raise
+            finally:
+                handler_var.reset(token)
+                elapsed = time.perf_counter() - started
+                histogram.observe(elapsed)
+                query = getattr(update, 'callback_query', None)
+                if query is not None and query.data:
+                    self.callback_histogram(query.data).observe(elapsed)
+        return wrapper
+
+    # Оборачивает callback всех обработчиков приложения, включая состояния ConversationHandler
+    def instrument_application(self, application):
+        def walk(handlers):
+            for handler in handlers:
+                if hasattr(handler, 'entry_points'):
+                    walk(handler.entry_points)
+                    for state_handlers in handler.states.values():
+                        walk(state_handlers)
+                    walk(handler.fallbacks)
+                elif not getattr(handler.callback, '__wrapped__', None):
+                    handler.callback = self.instrument(handler.callback)
+        for group in application.handlers.values():
+            walk(group)
+
+    def render(self):
+        lines = []
+
+        def histograms(name, help_text, label, items):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in items.items():
+                lines.extend(histogram.render(name, f'{label}="{key}"'))
+
+        histograms('bot_handler_duration_seconds', 'Handler latency.', 'handler', self.handlers)
+        histograms('bot_callback_duration_seconds', 'Handler latency by callback_data.', 'callback', self.callbacks)
+        histograms('bot_api_request_duration_seconds', 'Bot API call latency.', 'method', self.api_calls)
+
+        lines.append('# HELP bot_errors_total Errors by exception type.')
+        lines.append('# TYPE bot_errors_total counter')
+        for (source, name, error), count in self.errors.items():
+            lines.append(f'bot_errors_total{{source="{source}",name="{name}",type="{error}"}} {count}')
+
+        for name, (kind, help_text, func) in self.samples.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# HTTP клиент Bot API с замером времени каждого вызова.
+# post() - публичная точка входа BaseRequest, ошибки Telegram (429, 400 и т.п.) поднимаются уже из неё.
+class InstrumentedRequest(HTTPXRequest):
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        histogram = metrics.api_histogram(method)
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            metrics.count_error('api', method, e)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
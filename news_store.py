@@ -0,0 +1,168 @@
+import os
+import json
+import asyncio
+import bisect
+import logging
+import contextlib
+
+try:
+    import fcntl
+except ImportError:   # Windows: блокировка между процессами недоступна, один процесс работает и без неё
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+# Хранилище новостей в памяти.
+# news.json - снимок (массив новостей), рядом news.log - журнал добавлений (по одной новости на строку JSON).
+# Новость дописывается в журнал, а раз в COMPACT_EVERY добавлений журнал сворачивается в снимок
+# через временный файл и os.replace, поэтому файл никогда не остаётся недописанным.
+# Файлы могут делить несколько процессов (воркеры shard.py): запись и сворачивание идут
+# под блокировкой файла news.lock, а остальные процессы перечитывают файлы по изменению mtime.
+class NewsStore:
+    COMPACT_EVERY = 50
+
+    def __init__(self, path, log_path=None):
+        self.path = path
+        self.log_path = log_path or os.path.splitext(path)[0] + '.log'
+        self.lock_path = os.path.splitext(path)[0] + '.lock'
+        self._items = []        # новости, отсортированные по timestamp
+        self._timestamps = []   # ключи сортировки для bisect
+        self._mtimes = None
+        self._lock = asyncio.Lock()
+
+    def _stat(self):
+        result = []
+        for path in (self.path, self.log_path):
+            try:
+                st = os.stat(path)
+                result.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                result.append(None)
+        return tuple(result)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            return items if isinstance(items, list) else []
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    def _read_log(self):
+        items = []
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        items.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Недописанная последняя строка после падения - пропускаем
+                        logger.warning("Пропущена повреждённая строка в %s", self.log_path)
+        except FileNotFoundError:
+            pass
+        return items
+
+    def _load(self):
+        stat = self._stat()
+        items = self._read_all()
+        self._items = items
+        self._timestamps = [item.get('timestamp') or 0 for item in items]
+        self._mtimes = stat
+
+    def refresh(self):
+        # Перечитываем файлы только если их изменили снаружи (правка руками, другой процесс)
+        if self._stat() != self._mtimes:
+            self._load()
+
+    def count(self):
+        self.refresh()
+        return len(self._items)
+
+    def items(self):
+        self.refresh()
+        return list(self._items)
+
+    def page(self, page, size):
+        # Страница новостей, начиная с самых свежих. Стоимость - O(size)
+        self.refresh()
+        end = len(self._items) - page * size
+        if end <= 0:
+            return []
+        start = max(0, end - size)
+        return self._items[start:end][::-1]
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_all(self):
+        items = self._read_snapshot() + self._read_log()
+        items.sort(key=lambda item: item.get('timestamp') or 0)
+        return items
+
+    def _locked_add(self, item):
+        # Только файлы и только под блокировкой: другой процесс мог дописать журнал или свернуть его.
+        # Возвращает состояние файлов до и после записи
+        with self._file_lock():
+            before = self._stat()
+            self._append(item)
+            if len(self._read_log()) >= self.COMPACT_EVERY:
+                self._compact(self._read_all())
+            return before, self._stat()
+
+    def _locked_compact(self):
+        with self._file_lock():
+            if self._read_log():
+                self._compact(self._read_all())
+
+    def _append(self, item):
+        line = json.dumps(item, ensure_ascii=False) + '\n'
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self, items):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+
+    async def add(self, item):
+        # Запись на диск идёт в отдельном потоке, а lock не даёт двум админам затереть друг друга.
+        # Новость с уже записанным update_id (апдейт прогнан повторно после падения) не добавляется
+        async with self._lock:
+            update_id = item.get('update_id')
+            if update_id is not None and any(saved.get('update_id') == update_id for saved in self.items()):
+                return
+            before, after = await asyncio.to_thread(self._locked_add, item)
+            # Если до записи память совпадала с файлами, достаточно вставить новость;
+            # иначе (файлы менял другой процесс) refresh перечитает их при следующем чтении
+            if self._mtimes == before:
+                ts = item.get('timestamp') or 0
+                index = bisect.bisect_right(self._timestamps, ts)
+                self._timestamps.insert(index, ts)
+                self._items.insert(index, item)
+                self._mtimes = after
+
+    async def compact(self):
+        async with self._lock:
+            await asyncio.to_thread(self._locked_compact)
@@ -0,0 +1,400 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from telegram import InputMediaPhoto, InputMediaDocument
+from telegram.error import RetryAfter, NetworkError, BadRequest
+
+from ledger import connect
+
+logger = logging.getLogger(__name__)
+
+
+# Token bucket: rate токенов в секунду, не больше capacity в запасе
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Сколько ждать до следующего токена; если ждать не нужно - токен сразу списывается
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+# Token bucket в bot.db, общий для процессов пула (shard.py): лимит Telegram на сообщения в группу
+# один на бота, а не на процесс. Пополнение и списание идут одной транзакцией, поэтому два воркера
+# не потратят один токен. Время - time.time(), одно на все процессы.
+class SharedTokenBucket:
+    def __init__(self, outbox, name, rate, capacity):
+        self.outbox = outbox
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def _delay(self):
+        conn = self.outbox._conn
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, self.capacity, now)
+            )
+            conn.execute(
+                "UPDATE rate_limits SET tokens = MIN(?, tokens + MAX(0, ? - updated) * ?), updated = MAX(updated, ?) "
+                "WHERE name = ?",
+                (self.capacity, now, self.rate, now, self.name)
+            )
+            (tokens,) = conn.execute("SELECT tokens FROM rate_limits WHERE name = ?", (self.name,)).fetchone()
+            if tokens >= 1:
+                conn.execute("UPDATE rate_limits SET tokens = tokens - 1 WHERE name = ?", (self.name,))
+                return 0
+        return (1 - tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = await self.outbox._write_db(self._delay)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    update_id INTEGER UNIQUE,
+    request_id INTEGER,
+    chat_id INTEGER,
+    priority INTEGER NOT NULL,
+    calls TEXT NOT NULL,
+    sent_calls INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    confirmed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_queued ON outbox (status, id);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+INPUT_MEDIA = {"photo": InputMediaPhoto, "document": InputMediaDocument}
+
+
+def retry_after_seconds(error):
+    if isinstance(error.retry_after, datetime.timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
+
+
+# Вызовы хранятся в базе как JSON: альбомы (InputMedia*) - списком [тип, file_id, подпись].
+# Третий элемент вызова, если есть, - запасной вызов на случай BadRequest (см. Outbox._send)
+def encode_call(call):
+    method, kwargs, *fallback = call
+    kwargs = dict(kwargs)
+    if "media" in kwargs:
+        kwargs["media"] = [[item.type, item.media, item.caption] for item in kwargs["media"]]
+    return [method, kwargs] + [encode_call(item) for item in fallback]
+
+
+def decode_call(call):
+    method, kwargs, *fallback = call
+    if "media" in kwargs:
+        kwargs["media"] = [INPUT_MEDIA[kind](media=media, caption=caption) for kind, media, caption in kwargs["media"]]
+    return (method, kwargs) + tuple(decode_call(item) for item in fallback)
+
+
+# Очередь исходящих сообщений.
+# Задание - список вызовов Bot API (имя метода + аргументы [+ запасной вызов]), которые уходят строго по порядку
+# одним воркером, поэтому текст и фото одного запроса не перемешиваются с чужими.
+# Перед каждым вызовом берутся токены из общего лимита и из лимита чата.
+# Задания хранятся в таблице outbox (bot.db): submit возвращает управление, когда задание записано,
+# после каждого вызова запоминается, сколько вызовов задания уже ушло, отправленное задание
+# получает status = 'sent'. Покупателю подтверждают запрос после submit, поэтому при остановке
+# очередь не досылается и не теряется: неотправленные задания уходят после следующего запуска.
+# update_id - ключ задания: повторный submit из того же апдейта (апдейт прогоняется заново
+# после перезапуска, см. UpdateInbox) нового задания не создаёт. confirm(update_id) запоминает,
+# что покупателю ответили, чтобы при повторе не отвечать ещё раз; delivered(update_id) ждёт,
+# пока задание апдейта уйдёт (или получит 'failed'), - до этого апдейт не отмечается обработанным.
+# Сетевые ошибки и флуд-лимит повторяются, пока вызов не пройдёт; задание с ошибкой,
+# которую повтор не исправит (BadRequest, Forbidden), помечается 'failed'. Ошибки базы при записи
+# прогресса и общего лимита тоже повторяются (_write_db), задание из очереди при этом не выпадает.
+# В пуле воркеров (shard.py) таблицу делят все процессы: при старте воркер забирает только задания
+# своих чатов (owns(chat_id), chat_id - чат покупателя), а с shared_limits лимит на группу
+# берётся из общего SharedTokenBucket. Так после изменения размера пула очередь досылают новые
+# владельцы чатов, и каждый воркер может отправлять в группу с полной скоростью, если остальные молчат.
+class Outbox:
+    PRIORITY_REQUEST = 0   # запросы покупателей
+    PRIORITY_HELP = 1      # запросы помощи
+    LANES = {PRIORITY_REQUEST: "request", PRIORITY_HELP: "help"}
+
+    def __init__(self, path, maxsize=1000, global_rate=25, group_rate=20 / 60, group_burst=20,
+                 private_rate=1, private_burst=3, backoff=1.0, max_backoff=60.0, keep=7 * 24 * 3600,
+                 owns=None, shared_limits=False):
+        self.path = path
+        self.owns = owns
+        self.shared_limits = shared_limits
+        self.maxsize = maxsize
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.private_rate, self.private_burst = private_rate, private_burst
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.keep = keep
+        self.chat_buckets = {}
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="outbox")
+        self._conn = None
+        self.queue = None
+        self.worker = None
+        self.bot = None
+        self._undelivered = {}    # update_id -> asyncio.Event, задания этого процесса в очереди
+        self._sending = False     # вызов API отправлен, а его результат ещё не записан
+        self._stopping = False
+        self.stats = {
+            "queued": 0, "sent": 0, "retried": 0, "failed": 0, "rejected": 0, "restored": 0,
+            "depth": 0, "max_depth": 0,
+            "depth_request": 0, "depth_help": 0,
+        }
+
+    def _run_db(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _write_db(self, func, *args):
+        # Запись, без которой задание нельзя продолжить: при ошибке (например, "database is locked",
+        # когда bot.db пишут несколько процессов) она повторяется с backoff, как пачки журнала запросов.
+        # Иначе задание осталось бы 'queued' до перезапуска, а апдейт, который ждёт delivered, не отметился бы
+        delay = self.backoff
+        while True:
+            try:
+                return await self._run_db(func, *args)
+            except Exception as e:
+                logger.error("Очередь отправки: %s не записано в базу: %s, повтор через %.1f с", func.__name__, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id - группа, у Telegram для групп лимит ~20 сообщений в минуту
+            if chat_id < 0 and self.shared_limits:
+                bucket = SharedTokenBucket(self, f"chat:{chat_id}", self.group_rate, self.group_burst)
+            elif chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _update_depth(self, priority, delta):
+        self.stats[f"depth_{self.LANES[priority]}"] += delta
+        self.stats["depth"] = self.queue.qsize()
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.stats["depth"])
+
+    def _enqueue(self, priority, job):
+        if job["update_id"] is not None:
+            self._undelivered.setdefault(job["update_id"], asyncio.Event())
+        self.queue.put_nowait((priority, job["id"], job))
+        self._update_depth(priority, 1)
+
+    # --- база ---
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        # Очередь, созданная до появления колонки confirmed
+        if "confirmed" not in [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 0")
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM outbox WHERE status != 'queued' AND created_at < ?", (time.time() - self.keep,)
+            )
+        return self._conn.execute(
+            "SELECT id, update_id, chat_id, priority, calls, sent_calls FROM outbox WHERE status = 'queued' ORDER BY id"
+        ).fetchall()
+
+    def _insert(self, update_id, request_id, chat_id, priority, calls):
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (update_id, request_id, chat_id, priority, calls, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (update_id, request_id, chat_id, priority, calls, time.time())
+            )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def _save_progress(self, job_id, sent_calls, status):
+        with self._conn:
+            self._conn.execute("UPDATE outbox SET sent_calls = ?, status = ? WHERE id = ?", (sent_calls, status, job_id))
+
+    def _select_by_update(self, update_id):
+        return self._conn.execute(
+            "SELECT request_id, status, confirmed FROM outbox WHERE update_id = ?", (update_id,)
+        ).fetchone()
+
+    def _set_confirmed(self, update_id):
+        with self._conn:
+            self._conn.execute("UPDATE outbox SET confirmed = 1 WHERE update_id = ?", (update_id,))
+
+    async def find(self, update_id):
+        # Задание, созданное апдейтом update_id: {"request_id", "status", "confirmed"} или None
+        row = await self._run_db(self._select_by_update, update_id)
+        return None if row is None else {"request_id": row[0], "status": row[1], "confirmed": bool(row[2])}
+
+    async def confirm(self, update_id):
+        await self._run_db(self._set_confirmed, update_id)
+
+    async def delivered(self, update_id):
+        event = self._undelivered.get(update_id)
+        if event is not None:
+            await event.wait()
+
+    # --- постановка в очередь ---
+
+    async def submit(self, priority, calls, update_id=None, request_id=None, chat_id=None):
+        # Поднимает asyncio.QueueFull, если очередь переполнена.
+        # Возвращает False, если задание с этим update_id уже есть
+        if self.queue.qsize() >= self.maxsize:
+            self.stats["rejected"] += 1
+            raise asyncio.QueueFull
+        encoded = json.dumps([encode_call(call) for call in calls], ensure_ascii=False)
+        job_id = await self._run_db(self._insert, update_id, request_id, chat_id, priority, encoded)
+        if job_id is None:
+            return False
+        self._enqueue(priority, {"id": job_id, "update_id": update_id, "calls": list(calls), "sent": 0})
+        self.stats["queued"] += 1
+        return True
+
+    # --- отправка ---
+
+    async def _call(self, method, kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.global_bucket.acquire()
+            await self._chat_bucket(kwargs["chat_id"]).acquire()
+            self._sending = True
+            try:
+                result = await getattr(self.bot, method)(**kwargs)
+                self.stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning("%s: флуд-лимит, ждём %s с", method, delay)
+            except BadRequest:
+                # В PTB это подкласс NetworkError, но повтор его не исправит
+                self._sending = False
+                raise
+            except NetworkError as e:
+                delay = min(self.max_backoff, self.backoff * 2 ** min(attempt - 1, 16)) * random.uniform(0.5, 1.5)
+                logger.warning("%s: сетевая ошибка %s, повтор через %.1f с", method, e, delay)
+            except BaseException:
+                self._sending = False
+                raise
+            self._sending = False
+            self.stats["retried"] += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, job):
+        # Вызовы задания по порядку, начиная с первого неотправленного
+        calls = job["calls"]
+        while job["sent"] < len(calls):
+            if self._stopping:
+                return
+            method, kwargs, *fallback = calls[job["sent"]]
+            try:
+                try:
+                    await self._call(method, kwargs)
+                except BadRequest as e:
+                    # Например, copy_message, когда покупатель уже удалил своё сообщение
+                    if not fallback:
+                        raise
+                    logger.warning("%s: %s, отправляем запасным вызовом %s", method, e, fallback[0][0])
+                    await self._call(*fallback[0][:2])
+                job["sent"] += 1
+                # Вызов уже отправлен: повторяется только запись прогресса, не сам вызов
+                await self._write_db(
+                    self._save_progress, job["id"], job["sent"], "sent" if job["sent"] == len(calls) else "queued"
+                )
+            finally:
+                self._sending = False
+
+    async def _run(self):
+        while not self._stopping:
+            priority, _, job = await self.queue.get()
+            self._update_depth(priority, -1)
+            finished = False
+            try:
+                await self._send(job)
+                finished = job["sent"] == len(job["calls"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Вызов API не удался и повтор его не исправит (BadRequest, Forbidden, ошибка в самом задании).
+                # Задание отмечается 'failed', чтобы не висеть в очереди и не держать апдейт в журнале
+                self.stats["failed"] += 1
+                logger.error("Исходящее сообщение не отправлено (задание %s): %s", job["id"], e)
+                await self._write_db(self._save_progress, job["id"], job["sent"], "failed")
+                finished = True
+            finally:
+                self.queue.task_done()
+            event = self._undelivered.pop(job["update_id"], None) if finished else None
+            if event is not None:
+                event.set()
+
+    async def start(self, bot):
+        self.bot = bot
+        self.queue = asyncio.PriorityQueue()
+        self._stopping = False
+        rows = await self._run_db(self._open)
+        if self.owns is not None:
+            rows = [row for row in rows if self.owns(row[2])]
+        for job_id, update_id, _, priority, calls, sent_calls in rows:
+            calls = [decode_call(call) for call in json.loads(calls)]
+            self._enqueue(priority, {"id": job_id, "update_id": update_id, "calls": calls, "sent": sent_calls})
+        self.stats["restored"] = len(rows)
+        if rows:
+            logger.info("В очереди отправки с прошлого запуска: %s заданий", len(rows))
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        if self.worker is None:
+            return
+        self._stopping = True
+        # Если вызов API уже отправлен, дожидаемся ответа и записи результата, иначе после
+        # перезапуска он ушёл бы ещё раз. Остальные задания остаются в базе до следующего запуска
+        if self._sending:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.worker), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Остановка: вызов API не завершился за %s с", timeout)
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+        if self.queue.qsize():
+            logger.info("Остановка: %s заданий уйдут после перезапуска", self.queue.qsize())
+        await self._run_db(self._conn.close)
+        self._conn = None
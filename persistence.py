@@ -0,0 +1,202 @@
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+
+from ledger import connect
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+# Хранение user_data и состояний ConversationHandler в SQLite, по строке на пользователя/диалог.
+# - user_data не читается целиком при старте: строка пользователя подгружается
+#   в refresh_user_data перед первым его апдейтом;
+# - update_* только запоминают изменившиеся строки, а запись идёт пачкой чуть позже
+#   (и в flush при остановке), поэтому стоимость сброса зависит от числа изменений, а не пользователей;
+# - в базе хранятся только непустые user_data и незавершённые диалоги;
+# - commit пишет изменения сразу: UpdateInbox отмечает апдейт обработанным только после него.
+# Значения сериализуются в JSON, поэтому в user_data нужно класть только строки, числа, bool, списки и словари.
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path, update_interval=5, flush_delay=0.5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.flush_delay = flush_delay
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="persistence")
+        self._conn = None
+        self._open_lock = asyncio.Lock()
+        self._stored = {}        # user_id -> JSON из базы (для загруженных пользователей)
+        self._dirty_users = {}   # user_id -> новый JSON или None (удалить строку)
+        self._dirty_conversations = {}  # (name, key) -> JSON состояния или None
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    async def _ensure_open(self):
+        async with self._open_lock:
+            if self._conn is None:
+                await self._run(self._open)
+
+    # --- user_data ---
+
+    async def get_user_data(self):
+        # Ничего не грузим заранее - см. refresh_user_data
+        await self._ensure_open()
+        return {}
+
+    def _load_user(self, user_id):
+        row = self._conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._stored:
+            return
+        stored = await self._run(self._load_user, user_id)
+        # Пока ждали базу, пользователь мог уже загрузиться
+        if user_id in self._stored:
+            return
+        self._stored[user_id] = stored
+        if stored is not None and user_id not in self._dirty_users:
+            user_data.update(json.loads(stored))
+
+    async def update_user_data(self, user_id, data):
+        encoded = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self._dirty_users.get(user_id, self._stored.get(user_id)) == encoded:
+            return
+        self._dirty_users[user_id] = encoded
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+        self._schedule_flush()
+
+    # --- ConversationHandler ---
+
+    def _load_conversations(self, name):
+        rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_conversations(self, name):
+        # Незавершённых диалогов немного, их можно прочитать целиком
+        await self._ensure_open()
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        encoded = None if new_state is None else json.dumps(new_state)
+        self._dirty_conversations[(name, json.dumps(list(key)))] = encoded
+        self._schedule_flush()
+
+    # --- запись ---
+
+    def _write(self, users, conversations):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, data) for user_id, data in users.items() if data is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in users.items() if data is None]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+
+    async def _write_dirty(self):
+        # Под lock: commit должен дождаться уже начатой записи, а не обогнать её
+        async with self._write_lock:
+            if not self._dirty_users and not self._dirty_conversations:
+                return True
+            users, self._dirty_users = self._dirty_users, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                await self._run(self._write, users, conversations)
+            except Exception as e:
+                logger.error("Не удалось сохранить состояние (%s пользователей): %s", len(users), e)
+                # Вернём несохранённое, если его не успели перезаписать новыми значениями
+                for user_id, data in users.items():
+                    self._dirty_users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+                return False
+            self._stored.update(users)
+            return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._write_dirty()
+
+    def _schedule_flush(self):
+        # Все update_* одного цикла update_persistence попадают в одну запись
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def commit(self):
+        # Записывает всё, что уже передано через update_*; поднимает RuntimeError, если запись не удалась
+        if not await self._write_dirty():
+            raise RuntimeError("состояние пользователей не сохранено")
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write_dirty()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    # --- не используются: chat_data, bot_data и callback_data не сохраняются ---
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,102 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.ext import BaseUpdateProcessor
+
+from logs import bind_update, reset_update
+
+logger = logging.getLogger(__name__)
+
+
+# Обработчик апдейтов: апдейты разных пользователей идут параллельно (не больше
+# max_concurrent_updates одновременно), а апдейты одного пользователя - строго по очереди,
+# иначе ломаются user_data (help_request, free_request, category) и news_conv_handler.
+# Пока апдейт пользователя обрабатывается, следующие его апдейты складываются в очередь
+# и выполняются тем же заданием, так что занятый пользователь держит не больше одного слота.
+# Когда все слоты заняты, новые апдейты ждут свободного слота; приём новых апдейтов
+# при длинной очереди ограничивает UpdateInbox (max_pending).
+# on_processed(update) вызывается после каждого обработанного апдейта (см. UpdateInbox.done).
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Лимит на слоты держим сами (self._slots), чтобы апдейты, ждущие слота, были видны в метриках.
+    # Семафору базового класса отдаём заведомо большое значение.
+    UNBOUNDED = 1 << 20
+
+    def __init__(self, max_concurrent_updates=16, on_processed=None):
+        super().__init__(self.UNBOUNDED)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._queues = {}     # ключ пользователя -> отложенные апдейты; ключ есть, пока пользователь занят
+        self._arrivals = {}   # id корутины -> время поступления, пока апдейт ждёт обработки
+        self.in_flight = 0
+        self.on_processed = on_processed
+
+    @staticmethod
+    def update_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+        return None
+
+    @property
+    def pending_updates(self):
+        return len(self._arrivals)
+
+    def oldest_pending_age(self):
+        if not self._arrivals:
+            return 0.0
+        return time.monotonic() - min(self._arrivals.values())
+
+    async def _run(self, update, coroutine):
+        self._arrivals.pop(id(coroutine), None)
+        self.in_flight += 1
+        # Записи лога во время обработки получают update_id, пользователя и длительность
+        tokens = bind_update(update)
+        try:
+            await coroutine
+        except Exception as e:
+            logger.error("Ошибка обработки апдейта: %s", e)
+        finally:
+            reset_update(tokens)
+            self.in_flight -= 1
+        # При отмене (CancelledError) апдейт не считается обработанным
+        if self.on_processed is not None:
+            self.on_processed(update)
+
+    async def do_process_update(self, update, coroutine):
+        self._arrivals[id(coroutine)] = time.monotonic()
+        key = self.update_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(update, coroutine)
+            return
+
+        pending = self._queues.get(key)
+        if pending is not None:
+            pending.append((update, coroutine))
+            return
+
+        pending = self._queues[key] = deque()
+        try:
+            async with self._slots:
+                await self._run(update, coroutine)
+                while pending:
+                    await self._run(*pending.popleft())
+        finally:
+            del self._queues[key]
+            # При отмене задачи отложенные корутины уже не выполнятся
+            for _, rest in pending:
+                self._arrivals.pop(id(rest), None)
+                rest.close()
+            self._arrivals.pop(id(coroutine), None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import signal
+import asyncio
+import hashlib
+import bisect
+import logging
+import secrets
+
+import httpx
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Режим с несколькими процессами: SHARD_WORKERS=N (N > 1) и запуск через main.py.
+# Входной процесс (ingress) получает апдейты от Telegram (long polling или вебхук) и раздаёт их
+# N процессам-воркерам, каждый из которых - обычный bot.py в режиме BOT_MODE=worker.
+# Воркер выбирается по chat_id через консистентное хэширование (HashRing), так что все апдейты
+# одного чата попадают в один процесс и его user_data, альбомы и диалоги остаются локальными.
+# Общее хранилище - bot.db (SQLite: номера запросов, user_data, журналы) и файлы новостей;
+# на одной машине этого достаточно, несколько процессов SQLite разводит блокировками.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 1))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+# Секрет для приёма апдейтов воркером и для POST /pool/<секрет> (изменение размера пула)
+SHARD_SECRET = os.getenv('SHARD_SECRET') or secrets.token_urlsafe(32)
+SHARD_PATH = f"/shard/{SHARD_SECRET}"
+
+
+# Консистентное хэширование: у каждого узла vnodes точек на кольце, ключ принадлежит
+# первой точке по часовой стрелке. При добавлении узла переезжает ~1/N ключей.
+class HashRing:
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = list(nodes)
+        points = sorted(
+            (self._hash(f"{node}-{i}"), node) for node in self.nodes for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def shard_key(update):
+    # Ключ шардирования по JSON апдейта: chat_id, а для апдейтов без чата - id пользователя
+    for name, payload in update.items():
+        if name == 'update_id' or not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+        user = payload.get('from') or payload.get('user')
+        if user and 'id' in user:
+            return user['id']
+    return 0
+
+
+ring = HashRing(range(SHARD_COUNT))
+
+
+def owns(update):
+    # Принадлежит ли апдейт (JSON) этому воркеру: SHARD_INDEX на кольце из SHARD_COUNT воркеров
+    return owns_chat(shard_key(update))
+
+
+def owns_chat(chat_id):
+    # То же для chat_id, например чата покупателя у задания из очереди отправки (Outbox)
+    return ring.node_for(chat_id or 0) == SHARD_INDEX
+
+
+# Входной процесс: запускает воркеры, следит за ними и пересылает им апдейты пачками.
+# Апдейт подтверждается Telegram (offset getUpdates или ответ 200 на вебхук), только когда
+# воркер записал его в свой журнал (UpdateInbox), поэтому падение воркера или ingress апдейты не теряет,
+# а повторная пересылка безопасна - воркер отсекает повторы по update_id.
+class Ingress:
+    def __init__(self, token, api_url, web_server, workers, base_port, poll_timeout=30):
+        self.token = token
+        self.api_url = api_url
+        self.web_server = web_server
+        self.base_port = base_port
+        self.size = workers
+        self.poll_timeout = poll_timeout
+        self.ring = HashRing(range(workers))
+        self.processes = {}      # номер воркера -> процесс
+        self.client = None
+        # Пересылки идут параллельно, а изменение размера пула ждёт, пока они закончатся
+        self._state = asyncio.Condition()
+        self._forwarding = 0
+        self._resizing = False
+        self._stopping = False
+        self.stats = {'forwarded': 0, 'retries': 0, 'restarts': 0}
+
+    # --- воркеры ---
+
+    def _worker_url(self, index):
+        return f"http://127.0.0.1:{self.base_port + index}{SHARD_PATH}"
+
+    async def _spawn(self, index, count):
+        env = dict(
+            os.environ,
+            BOT_MODE='worker', PORT=str(self.base_port + index),
+            SHARD_WORKERS='1', SHARD_INDEX=str(index), SHARD_COUNT=str(count), SHARD_SECRET=SHARD_SECRET,
+        )
+        main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        process = await asyncio.create_subprocess_exec(sys.executable, main, env=env)
+        self.processes[index] = process
+        asyncio.create_task(self._watch(index, count, process))
+
+    async def _watch(self, index, count, process):
+        # Упавший воркер перезапускается; пока его нет, пересылка ему повторяется
+        code = await process.wait()
+        if self._stopping or self.processes.get(index) is not process:
+            return
+        logger.error("Воркер %s завершился с кодом %s, перезапускаем", index, code)
+        self.stats['restarts'] += 1
+        await asyncio.sleep(1)
+        if not self._stopping and self.processes.get(index) is process:
+            await self._spawn(index, count)
+
+    async def _stop_workers(self):
+        processes = list(self.processes.values())
+        self.processes = {}
+        for process in processes:
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        await asyncio.gather(*[process.wait() for process in processes])
+
+    async def _exclusive(self, func, *args):
+        # Выполняет func, когда нет ни одной пересылки; новые пересылки ждут окончания
+        async with self._state:
+            await self._state.wait_for(lambda: not self._resizing)
+            self._resizing = True
+            await self._state.wait_for(lambda: not self._forwarding)
+        try:
+            await func(*args)
+        finally:
+            async with self._state:
+                self._resizing = False
+                self._state.notify_all()
+
+    async def _restart_pool(self, size):
+        logger.info("Изменение пула: %s -> %s воркеров", self.size, size)
+        await self._stop_workers()
+        self.size = size
+        self.ring = HashRing(range(size))
+        for index in range(size):
+            await self._spawn(index, size)
+
+    async def resize(self, size):
+        # Пул останавливается целиком: каждый воркер дорабатывает принятые апдейты и сбрасывает
+        # user_data и состояния диалогов в bot.db, новые воркеры читают их оттуда по новому кольцу.
+        # Пока пул перезапускается, апдейты ждут в Telegram (не подтверждены) или у ingress.
+        # Неотправленные в группу запросы остаются в bot.db и уходят от новых владельцев их чатов (см. Outbox).
+        await self._exclusive(self._restart_pool, size)
+
+    # --- пересылка ---
+
+    async def _post(self, index, updates):
+        delay = 0.05
+        while True:
+            try:
+                response = await self.client.post(self._worker_url(index), content=json.dumps(updates))
+                if response.status_code == 200:
+                    return
+                error = f"HTTP {response.status_code}"
+            except httpx.HTTPError as e:
+                error = repr(e)
+            # Воркер ещё запускается или перезапускается
+            self.stats['retries'] += 1
+            if delay >= 1:
+                logger.warning("Воркер %s не принял %s апдейтов: %s", index, len(updates), error)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+    async def forward(self, updates):
+        async with self._state:
+            await self._state.wait_for(lambda: not self._resizing)
+            self._forwarding += 1
+        try:
+            groups = {}
+            for update in updates:
+                groups.setdefault(self.ring.node_for(shard_key(update)), []).append(update)
+            await asyncio.gather(*[self._post(index, group) for index, group in groups.items()])
+            self.stats['forwarded'] += len(updates)
+        finally:
+            async with self._state:
+                self._forwarding -= 1
+                self._state.notify_all()
+
+    # --- Bot API ---
+
+    async def _call(self, method, **params):
+        response = await self.client.post(
+            f"{self.api_url}{self.token}/{method}",
+            data={
+                key: value if isinstance(value, str) else json.dumps(value)
+                for key, value in params.items() if value is not None
+            },
+            timeout=self.poll_timeout + 10
+        )
+        data = response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data['result']
+
+    async def poll(self):
+        # Как UpdateInbox._poll: любая ошибка, в том числе при снятии вебхука, повторяется с паузой
+        webhook_deleted = False
+        offset = None
+        delay = 1
+        while True:
+            method = 'getUpdates'
+            try:
+                if not webhook_deleted:
+                    method = 'deleteWebhook'
+                    await self._call('deleteWebhook', drop_pending_updates=False)
+                    webhook_deleted = True
+                    method = 'getUpdates'
+                updates = await self._call(
+                    'getUpdates', offset=offset, timeout=self.poll_timeout, allowed_updates=Update.ALL_TYPES
+                )
+            except (httpx.HTTPError, RuntimeError, ValueError) as e:
+                logger.warning("%s: %s, повтор через %s с", method, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            if updates:
+                await self.forward(updates)
+                offset = updates[-1]['update_id'] + 1
+
+    def make_webhook_handler(self, secret):
+        async def webhook(headers, body):
+            if headers.get('x-telegram-bot-api-secret-token') != secret:
+                return 403, 'text/plain', b'Forbidden'
+            try:
+                update = json.loads(body)
+            except ValueError:
+                return 400, 'text/plain', b'Bad Request'
+            await self.forward([update])
+            return 200, 'text/plain', b'OK'
+        return webhook
+
+    async def resize_handler(self, headers, body):
+        try:
+            size = int(body)
+        except ValueError:
+            return 400, 'text/plain', b'Bad Request'
+        if size < 1:
+            return 400, 'text/plain', b'Bad Request'
+        await self.resize(size)
+        return 200, 'text/plain', b'OK'
+
+    async def health(self, headers, body):
+        alive = sum(1 for process in self.processes.values() if process.returncode is None)
+        return 200, 'text/plain', f"Ingress is alive, workers: {alive}/{self.size}".encode()
+
+    async def run(self, mode='polling', webhook_url='', webhook_path='', webhook_secret=''):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        self.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=64))
+        self.web_server.route('GET', '/', self.health)
+        self.web_server.route('POST', f"/pool/{SHARD_SECRET}", self.resize_handler)
+        await self.web_server.start()
+        for index in range(self.size):
+            await self._spawn(index, self.size)
+
+        if mode == 'webhook':
+            self.web_server.route('POST', webhook_path, self.make_webhook_handler(webhook_secret))
+            if webhook_url:
+                # Те же типы апдейтов, что и в bot.py serve, иначе Telegram шлёт только типы по умолчанию
+                await self._call(
+                    'setWebhook', url=webhook_url.rstrip('/') + webhook_path, secret_token=webhook_secret,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            receiver = None
+        else:
+            receiver = asyncio.create_task(self.poll())
+        logger.info("Ingress: %s воркеров, порты %s-%s", self.size, self.base_port, self.base_port + self.size - 1)
+        try:
+            await stop.wait()
+        finally:
+            # Сначала перестаём принимать апдейты, затем воркеры дорабатывают принятые
+            self._stopping = True
+            if receiver is not None:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+            await self.web_server.stop()
+            await self._exclusive(self._stop_workers)
+            await self.client.aclose()
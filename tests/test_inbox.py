@@ -0,0 +1,172 @@
+# Журнал входящих апдейтов (UpdateInbox): перезапуск посреди очереди и ошибки long polling.
+# Обработчик апдейтов здесь - простая задача, которая забирает апдейты из update_queue.
+#   python -m unittest discover tests
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update
+from telegram.error import NetworkError
+
+from inbox import UpdateInbox
+
+
+def start_update(update_id):
+    uid = 40_000 + update_id % 7
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}"},
+            "text": "/start",
+        },
+    }, None)
+
+
+class Consumer:
+    # Разбирает update_queue, как Application: апдейт обработан - inbox.done
+    def __init__(self, inbox, application, handled, limit=None):
+        self.inbox = inbox
+        self.queue = application.update_queue
+        self.handled = handled
+        self.limit = limit
+        self.stopped = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            update = await self.queue.get()
+            self.handled.append(update.update_id)
+            self.inbox.done(update)
+            self.queue.task_done()
+            if self.limit is not None and len(self.handled) >= self.limit:
+                self.stopped.set()
+                return
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+
+class RestartTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix="inbox-test-"), "bot.db")
+
+    async def start_inbox(self):
+        inbox = UpdateInbox(self.path, flush_interval=0.01)
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+        await inbox.start(application)
+        return inbox, application
+
+    async def test_stop_mid_stream_then_restart_handles_each_update_once(self):
+        updates = [start_update(update_id) for update_id in range(1, 31)]
+
+        # Первый запуск: все апдейты записаны, обработано только 12, затем остановка
+        inbox, application = await self.start_inbox()
+        await inbox.drain()
+        first = []
+        consumer = Consumer(inbox, application, first, limit=12)
+        await inbox.accept(updates)
+        await asyncio.wait_for(consumer.stopped.wait(), 5)
+        await consumer.stop()
+        await inbox.stop()
+        self.assertEqual(first, list(range(1, 13)))
+
+        # Второй запуск на той же базе: журнал прогоняет необработанные, Telegram присылает
+        # неподтверждённые апдейты ещё раз - они отсекаются как повторы
+        inbox, application = await self.start_inbox()
+        self.assertEqual(inbox.offset, 31)
+        second = []
+        consumer = Consumer(inbox, application, second)
+        await inbox.drain()
+        await inbox.accept(updates[20:] + [start_update(31)])
+        await asyncio.wait_for(application.update_queue.join(), 5)
+        await consumer.stop()
+        await inbox.stop()
+
+        self.assertEqual(second, list(range(13, 32)))
+        handled = first + second
+        self.assertEqual(sorted(handled), list(range(1, 32)))
+        self.assertEqual(len(handled), len(set(handled)))
+        self.assertEqual(inbox.stats["replayed"], 18)
+        self.assertEqual(inbox.stats["duplicates"], 10)
+
+        # Третий запуск: повторять больше нечего
+        inbox, application = await self.start_inbox()
+        await inbox.drain()
+        self.assertEqual(inbox.stats["replayed"], 0)
+        await inbox.stop()
+
+
+class FlakyBot:
+    # deleteWebhook падает первый раз, getUpdates отдаёт одну пачку и дальше пустые ответы
+    def __init__(self, updates):
+        self.updates = updates
+        self.delete_calls = 0
+        self.offsets = []
+
+    async def delete_webhook(self, drop_pending_updates=False):
+        self.delete_calls += 1
+        if self.delete_calls == 1:
+            raise NetworkError("connection reset")
+        return True
+
+    async def get_updates(self, offset=None, timeout=None, allowed_updates=None):
+        self.offsets.append(offset)
+        if len(self.offsets) == 1:
+            return self.updates
+        await asyncio.sleep(0.05)
+        return []
+
+
+class PollingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_poller_retries_webhook_removal_and_journal_errors(self):
+        path = os.path.join(tempfile.mkdtemp(prefix="inbox-test-"), "bot.db")
+        updates = [start_update(update_id) for update_id in range(1, 4)]
+        bot = FlakyBot(updates)
+        inbox = UpdateInbox(path)
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=bot)
+        await inbox.start(application)
+        await inbox.drain()
+
+        # Первая запись пачки в журнал падает, как при "database is locked"
+        insert = inbox._insert
+        failures = []
+
+        def flaky_insert(rows):
+            if not failures:
+                failures.append(rows)
+                raise sqlite3.OperationalError("database is locked")
+            return insert(rows)
+
+        inbox._insert = flaky_insert
+        inbox.start_polling()
+        for _ in range(100):
+            if application.update_queue.qsize() == 3:
+                break
+            await asyncio.sleep(0.1)
+        poller = inbox._poller
+        self.assertFalse(poller.done())
+        await inbox.stop()
+
+        self.assertEqual(bot.delete_calls, 2)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(application.update_queue.qsize(), 3)
+        # Пачка, не записанная в журнал, не запрашивалась заново и не подтверждалась до записи
+        self.assertIsNone(bot.offsets[0])
+        self.assertTrue(all(offset == 4 for offset in bot.offsets[1:]))
+        self.assertEqual(inbox.offset, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# Очередь отправки (Outbox): ошибки базы во время отправки не теряют задание и не повторяют вызовы.
+#   python -m unittest discover tests
+import os
+import sys
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from outbox import Outbox
+
+GROUP_ID = -100500
+
+
+class RecordingBot:
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, **kwargs):
+        self.calls.append(kwargs["text"])
+        return True
+
+
+class OutboxDatabaseErrorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        path = os.path.join(tempfile.mkdtemp(prefix="outbox-test-"), "bot.db")
+        self.outbox = Outbox(path, global_rate=1e6, group_rate=1e6, group_burst=1e6, backoff=0.05, shared_limits=True)
+        self.bot = RecordingBot()
+        await self.outbox.start(self.bot)
+
+    async def asyncTearDown(self):
+        await self.outbox.stop()
+
+    async def test_locked_database_is_retried_without_resending(self):
+        # Первые две записи прогресса падают: задание не выпадает из очереди, вызовы не повторяются
+        save = self.outbox._save_progress
+        failures = []
+
+        def flaky_save(*args):
+            if len(failures) < 2:
+                failures.append(args)
+                raise sqlite3.OperationalError("database is locked")
+            return save(*args)
+
+        self.outbox._save_progress = flaky_save
+        calls = [("send_message", {"chat_id": GROUP_ID, "text": "запрос"}),
+                 ("send_message", {"chat_id": GROUP_ID, "text": "фото"})]
+        self.assertTrue(await self.outbox.submit(Outbox.PRIORITY_REQUEST, calls, update_id=7, request_id=1,
+                                                 chat_id=30_000))
+        await asyncio.wait_for(self.outbox.delivered(7), 5)
+
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(self.bot.calls, ["запрос", "фото"])
+        self.assertEqual((await self.outbox.find(7))["status"], "sent")
+        self.assertEqual(self.outbox.stats["failed"], 0)
+
+    async def test_locked_rate_limit_table_is_retried(self):
+        bucket = self.outbox._chat_bucket(GROUP_ID)
+        delay = bucket._delay
+        failures = []
+
+        def flaky_delay():
+            if not failures:
+                failures.append(True)
+                raise sqlite3.OperationalError("database is locked")
+            return delay()
+
+        bucket._delay = flaky_delay
+        await self.outbox.submit(Outbox.PRIORITY_HELP, [("send_message", {"chat_id": GROUP_ID, "text": "помощь"})],
+                                 update_id=8, chat_id=30_001)
+        await asyncio.wait_for(self.outbox.delivered(8), 5)
+
+        self.assertEqual(failures, [True])
+        self.assertEqual(self.bot.calls, ["помощь"])
+        self.assertEqual((await self.outbox.find(8))["status"], "sent")
+
+
+if __name__ == "__main__":
+    unittest.main()
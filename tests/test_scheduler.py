@@ -0,0 +1,317 @@
+# Обработка апдейтов через PerUserUpdateProcessor на настоящих обработчиках bot.py.
+# Bot API подменён FakeRequest: вызовы записываются, на каждый - случайная задержка,
+# поэтому апдейты разных пользователей перемешиваются, а апдейты одного идут по порядку.
+#   python -m unittest discover tests
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp(prefix="bot-test-")
+GROUP_ID = -100500
+os.environ.update({
+    "TOKEN": "123456:TEST",
+    "TELEGRAM_GROUP_ID": str(GROUP_ID),
+    "DB_PATH": os.path.join(TMP, "bot.db"),
+    "NEWS_PATH": os.path.join(TMP, "news.json"),
+    "PORT": "0",
+    "LOG_LEVEL": "WARNING",
+    # news_flow идёт от пользователей 20_000 + index, /add_news доступна только админам
+    "ADMIN_IDS": ",".join(str(20_000 + index) for index in range(40)),
+})
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import bot
+from inbox import UpdateInbox
+from menus import CATEGORIES, CATEGORY_BY_CALLBACK
+from scheduler import PerUserUpdateProcessor
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+BROADCAST_MARK = "Отписаться от новостей"
+
+
+class FakeRequest(BaseRequest):
+    def __init__(self, seed, max_delay=0.005):
+        self.random = random.Random(seed)
+        self.max_delay = max_delay
+        self.calls = []          # (метод, параметры) в порядке завершения
+        self.in_flight = {}      # chat_id -> вызовов в работе
+        self.max_in_flight = {}  # chat_id -> максимум одновременных вызовов
+        self.total_in_flight = 0
+        self.max_total_in_flight = 0
+        self._message_id = 1000
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {**BOT_USER, "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        self._message_id += 1
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = params.get("chat_id", 0)
+            return {"message_id": self._message_id, "date": int(time.time()), "from": BOT_USER,
+                    "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                    "text": params.get("text", "")}
+        if method == "copyMessage":
+            return {"message_id": self._message_id}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        chat_id = params.get("chat_id")
+        # Рассылка новостей идёт в чаты покупателей параллельно с их апдейтами, её не считаем
+        tracked = chat_id is not None and BROADCAST_MARK not in str(params.get("text", ""))
+        if tracked:
+            self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+            self.max_in_flight[chat_id] = max(self.max_in_flight.get(chat_id, 0), self.in_flight[chat_id])
+        self.total_in_flight += 1
+        self.max_total_in_flight = max(self.max_total_in_flight, self.total_in_flight)
+        try:
+            await asyncio.sleep(self.random.uniform(0, self.max_delay))
+        finally:
+            self.total_in_flight -= 1
+            if tracked:
+                self.in_flight[chat_id] -= 1
+        self.calls.append((name, params))
+        return 200, json.dumps({"ok": True, "result": self._result(name, params)}).encode()
+
+    def texts(self, chat_id):
+        # Что бот отправил или показал в чате (без ответов на callback и рассылки)
+        return [
+            params.get("text") or params.get("caption")
+            for name, params in self.calls
+            if params.get("chat_id") == chat_id and name != "answerCallbackQuery"
+            and BROADCAST_MARK not in str(params.get("text", ""))
+        ]
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def _next(self, uid, payload_name, payload):
+        self.update_id += 1
+        return {"update_id": self.update_id, payload_name: payload}
+
+    def message(self, uid, text):
+        message = {
+            "message_id": self.update_id + 1,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._next(uid, "message", message)
+
+    def callback(self, uid, data):
+        return self._next(uid, "callback_query", {
+            "id": str(self.update_id + 1),
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"},
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": self.update_id + 1,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": BOT_USER,
+                "text": "menu",
+            },
+        })
+
+
+def category(index):
+    return CATEGORIES[index % len(CATEGORIES)][0]
+
+
+# Сценарии пользователей: список апдейтов и что бот должен показать в чате в ответ, по порядку
+def request_flow(f, uid, index):
+    key = category(index)
+    name, reply = CATEGORY_BY_CALLBACK[f"category_{key}"]
+    text = f"VIN WDB{uid:09d} нужна фара"
+    updates = [f.message(uid, "/start"), f.callback(uid, "product_selection"),
+               f.callback(uid, f"category_{key}"), f.message(uid, text)]
+    expected = ["Добро пожаловать", "🏪 Выберите категорию товара:", reply, "✅ Ваш запрос #"]
+    return updates, expected, (name, text)
+
+
+def help_flow(f, uid, index):
+    text = f"Не приходит код подтверждения {uid}"
+    updates = [f.message(uid, "/start"), f.callback(uid, "help"), f.message(uid, text)]
+    expected = ["Добро пожаловать", "❓ Опишите вашу проблему", "✅ Ваш запрос помощи отправлен"]
+    return updates, expected, ("help", text)
+
+
+def cancelled_flow(f, uid, index):
+    # Текст после отмены не должен уйти в группу: ломается, если он обогнал cancel
+    updates = [f.message(uid, "/start"), f.callback(uid, "help"), f.callback(uid, "cancel"),
+               f.message(uid, f"передумал {uid}")]
+    expected = ["Добро пожаловать", "❓ Опишите вашу проблему", "❌ Запрос отменён."]
+    return updates, expected, None
+
+
+def news_flow(f, uid, index):
+    updates = [f.message(uid, "/add_news"), f.message(uid, f"Отгрузка {uid}"), f.message(uid, "/skip")]
+    expected = ["📝 Введите текст новости", "📸 Теперь отправьте фото", "✅ Новость добавлена"]
+    return updates, expected, ("news", f"Отгрузка {uid}")
+
+
+FLOWS = (request_flow, help_flow, cancelled_flow, news_flow)
+
+
+def interleave(sequences):
+    # По одному апдейту от каждого пользователя по кругу
+    merged = []
+    for step in range(max(len(sequence) for sequence in sequences)):
+        merged.extend(sequence[step] for sequence in sequences if step < len(sequence))
+    return merged
+
+
+class PerUserUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    USERS = 40
+
+    async def asyncSetUp(self):
+        bot.outbox.global_bucket.rate = bot.outbox.global_bucket.capacity = 1e6
+        bot.outbox.group_rate = bot.outbox.group_burst = 1e6
+        bot.outbox.chat_buckets.clear()
+        self.request = FakeRequest(seed=1)
+        self.processed = []
+        self.all_processed = asyncio.Event()
+        self.processor = PerUserUpdateProcessor(8, on_processed=self.on_processed)
+        self.application = (
+            Application.builder()
+            .token(bot.TOKEN)
+            .request(self.request)
+            .concurrent_updates(self.processor)
+            .persistence(bot.SqlitePersistence(bot.DB_PATH))
+            .updater(None)
+            .build()
+        )
+        bot.add_handlers(self.application)
+        await self.application.initialize()
+        await bot.on_startup(self.application)
+        await self.application.start()
+
+    async def asyncTearDown(self):
+        await self.application.stop()
+        await bot.on_shutdown(self.application)
+        await self.application.shutdown()
+
+    def on_processed(self, update):
+        self.processed.append(update)
+        if len(self.processed) == self.expected_updates:
+            self.all_processed.set()
+
+    async def run_updates(self, updates):
+        self.expected_updates = len(updates)
+        for data in updates:
+            await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        await asyncio.wait_for(self.all_processed.wait(), 30)
+        await asyncio.wait_for(bot.outbox.queue.join(), 30)
+
+    async def test_interleaved_users_keep_state_and_order(self):
+        f = UpdateFactory()
+        users = {}
+        for index in range(self.USERS):
+            uid = 20_000 + index
+            users[uid] = FLOWS[index % len(FLOWS)](f, uid, index)
+        # Не админ пытается разослать новость: диалог не начинается, текст не становится новостью
+        intruder = 30_500
+        intrusion = [f.message(intruder, "/add_news"), f.message(intruder, "Отгрузка для всех")]
+        await self.run_updates(interleave([updates for updates, _, _ in users.values()] + [intrusion]))
+
+        # Разные пользователи шли параллельно, один пользователь - строго по одному апдейту
+        self.assertGreater(self.request.max_total_in_flight, 1)
+        for uid in users:
+            self.assertEqual(self.request.max_in_flight.get(uid), 1, uid)
+
+        # Апдейты каждого пользователя обработаны в порядке поступления
+        order = {}
+        for update in self.processed:
+            order.setdefault(update.effective_user.id, []).append(update.update_id)
+        for uid, (updates, _, _) in users.items():
+            self.assertEqual(order[uid], [update["update_id"] for update in updates], uid)
+
+        group = [params.get("text") or params.get("caption") for _, params in self.request.calls
+                 if params.get("chat_id") == GROUP_ID]
+        for uid, (_, expected, outcome) in users.items():
+            # Ответы в чате пользователя - по одному на шаг и в порядке шагов
+            texts = self.request.texts(uid)
+            self.assertEqual(len(texts), len(expected), (uid, texts))
+            for text, prefix in zip(texts, expected):
+                self.assertTrue(text.startswith(prefix), (uid, text, prefix))
+            # Состояние диалога в конце сброшено
+            self.assertFalse(self.application.user_data.get(uid), uid)
+            conversations = self.application._conversation_handler_conversations["news_conv"]
+            self.assertNotIn((uid, uid), conversations)
+
+            # В группу ушло ровно то, что пользователь отправил, со своей категорией
+            forwarded = [text for text in group if f"@user{uid}" in text]
+            if outcome is None or outcome[0] == "news":
+                self.assertEqual(forwarded, [], uid)
+            elif outcome[0] == "help":
+                self.assertEqual(len(forwarded), 1, uid)
+                self.assertTrue(forwarded[0].endswith(f"Запрос помощи от @user{uid}:\n{outcome[1]}"), uid)
+            else:
+                name, text = outcome
+                self.assertEqual(len(forwarded), 1, uid)
+                self.assertIn(f"из категории '{name}' от @user{uid}:\n", forwarded[0])
+                self.assertTrue(forwarded[0].endswith(text), uid)
+
+        # Каждая новость из news_conv_handler сохранена один раз
+        news = [item["text"] for item in bot.news_store.page(0, 100)]
+        for uid, (_, _, outcome) in users.items():
+            if outcome and outcome[0] == "news":
+                self.assertEqual(news.count(outcome[1]), 1, uid)
+        self.assertNotIn("Отгрузка для всех", news)
+        self.assertFalse(any(text.startswith("📝") for text in self.request.texts(intruder)))
+        self.assertNotIn((intruder, intruder), self.application._conversation_handler_conversations["news_conv"])
+
+
+class InboxBackpressureTest(unittest.IsolatedAsyncioTestCase):
+    async def test_accept_waits_while_too_many_updates_are_pending(self):
+        inbox = UpdateInbox(os.path.join(TMP, "inbox.db"), max_pending=2)
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+        await inbox.start(application)
+        await inbox.drain()
+        f = UpdateFactory()
+        updates = [Update.de_json(f.message(30_000 + i, "/start"), None) for i in range(3)]
+
+        await inbox.accept(updates[:2])
+        third = asyncio.create_task(inbox.accept(updates[2:]))
+        await asyncio.sleep(0.1)
+        self.assertFalse(third.done())
+        self.assertEqual(application.update_queue.qsize(), 2)
+
+        inbox.done(updates[0])
+        await asyncio.wait_for(third, 1)
+        self.assertEqual(application.update_queue.qsize(), 3)
+        self.assertEqual(inbox.stats["throttled"], 1)
+        await inbox.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY = 1024 * 1024
+READ_TIMEOUT = 10
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 429: "Too Many Requests",
+           500: "Internal Server Error"}
+
+
+# Минимальный асинхронный HTTP сервер, работает в том же event loop, что и бот.
+# Обработчик маршрута: async def handler(headers, body) -> (status, content_type, body)
+class WebServer:
+    def __init__(self, port, host="0.0.0.0"):
+        self.port = port
+        self.host = host
+        self.routes = {}
+        self.server = None
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        # Сервер мог быть запущен заранее (main.py), маршруты добавляются и после старта
+        if self.server is not None:
+            return
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("HTTP server running on port %s", self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY:
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), READ_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                request = False
+                status, content_type, body = 400, "text/plain", b"Bad Request"
+            if request is None:
+                # Клиент закрыл соединение, ничего не прислав
+                return
+            if request:
+                method, path, headers, body = request
+                path = path.split("?", 1)[0]
+                handler = self.routes.get((method, path))
+                if body is None:
+                    status, content_type, body = 413, "text/plain", b"Payload Too Large"
+                elif handler is None:
+                    status = 405 if any(p == path for _, p in self.routes) else 404
+                    content_type, body = "text/plain", REASONS[status].encode()
+                else:
+                    try:
+                        status, content_type, body = await handler(headers, body)
+                    except Exception as e:
+                        logger.error("Ошибка обработки %s %s: %s", method, path, e)
+                        status, content_type, body = 500, "text/plain", b"Internal Server Error"
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()